@@ -0,0 +1,58 @@
+"""Add article preview
+
+Revision ID: 3b1f6e2c9a47
+Revises: f9a010384b53
+Create Date: 2026-10-19 10:12:31.218440
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3b1f6e2c9a47"
+down_revision = "f9a010384b53"
+branch_labels = None
+depends_on = None
+
+PREVIEW_LENGTH = 80
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.add_column(
+        "article", sa.Column("preview", sa.String(PREVIEW_LENGTH), nullable=True)
+    )
+
+    conn = op.get_bind()
+    backfill = sa.text(
+        """
+        WITH batch AS (
+            SELECT id FROM article WHERE id > :last_id ORDER BY id LIMIT :batch_size
+        ), updated AS (
+            UPDATE article a SET preview = left(a.text, :length)
+            FROM batch b
+            WHERE a.id = b.id
+        )
+        SELECT max(id) FROM batch
+        """
+    )
+    last_id = 0
+    # env.py runs all migrations in one transaction, commit every batch so
+    # row locks are released as the backfill goes.
+    with op.get_context().autocommit_block():
+        while True:
+            last_id = conn.execute(
+                backfill,
+                last_id=last_id,
+                length=PREVIEW_LENGTH,
+                batch_size=BATCH_SIZE,
+            ).scalar()
+            if last_id is None:
+                break
+
+    op.alter_column("article", "preview", nullable=False)
+
+
+def downgrade():
+    op.drop_column("article", "preview")
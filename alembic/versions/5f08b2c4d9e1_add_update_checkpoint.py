@@ -0,0 +1,29 @@
+"""Add update checkpoint
+
+Revision ID: 5f08b2c4d9e1
+Revises: e1d7a3f86b20
+Create Date: 2026-10-19 15:31:14.902286
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5f08b2c4d9e1"
+down_revision = "e1d7a3f86b20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "update_checkpoint",
+        sa.Column("bot_id", sa.types.BigInteger(), nullable=False),
+        sa.Column("update_id", sa.types.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("bot_id"),
+    )
+
+
+def downgrade():
+    op.drop_table("update_checkpoint")
@@ -0,0 +1,66 @@
+"""Add article remind_at
+
+Revision ID: 8d24c0e5b613
+Revises: 3b1f6e2c9a47
+Create Date: 2026-10-19 11:02:47.530912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8d24c0e5b613"
+down_revision = "3b1f6e2c9a47"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.add_column(
+        "article", sa.Column("remind_at", sa.DateTime(timezone=True), nullable=True)
+    )
+    op.create_index(
+        "article_remind_at",
+        "article",
+        ["remind_at"],
+        postgresql_where=sa.text("remind_at IS NOT NULL"),
+    )
+
+    # Remind a day before expiry, or halfway through TTLs shorter than two
+    # days, same as bot.reminders.get_remind_at. Already expired articles
+    # are left without a reminder.
+    conn = op.get_bind()
+    backfill = sa.text(
+        """
+        WITH batch AS (
+            SELECT id FROM article WHERE id > :last_id ORDER BY id LIMIT :batch_size
+        ), updated AS (
+            UPDATE article a
+            SET remind_at = a.created_at + make_interval(days => s.article_ttl_in_days)
+                - LEAST(interval '1 day', make_interval(days => s.article_ttl_in_days) / 2)
+            FROM batch b, user_settings s
+            WHERE a.id = b.id
+                AND s.user_id = a.user_id
+                AND a.status = 'NEW'
+                AND a.created_at + make_interval(days => s.article_ttl_in_days) > now()
+        )
+        SELECT max(id) FROM batch
+        """
+    )
+    last_id = 0
+    # Commit every batch, see 3b1f6e2c9a47_add_article_preview.
+    with op.get_context().autocommit_block():
+        while True:
+            last_id = conn.execute(
+                backfill, last_id=last_id, batch_size=BATCH_SIZE
+            ).scalar()
+            if last_id is None:
+                break
+
+
+def downgrade():
+    op.drop_index("article_remind_at", table_name="article")
+    op.drop_column("article", "remind_at")
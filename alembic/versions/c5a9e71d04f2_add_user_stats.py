@@ -0,0 +1,78 @@
+"""Add user stats
+
+Revision ID: c5a9e71d04f2
+Revises: 8d24c0e5b613
+Create Date: 2026-10-19 12:20:05.114378
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c5a9e71d04f2"
+down_revision = "8d24c0e5b613"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    op.add_column(
+        "article", sa.Column("read_at", sa.DateTime(timezone=True), nullable=True)
+    )
+
+    op.create_table(
+        "user_stats",
+        sa.Column(
+            "user_id",
+            sa.Integer(),
+            sa.ForeignKey("telegram_user.id", ondelete="CASCADE"),
+            nullable=False,
+        ),
+        sa.Column("saved_count", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("read_count", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("unread_count", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column(
+            "timed_read_count", sa.Integer(), nullable=False, server_default="0"
+        ),
+        sa.Column(
+            "read_seconds_total", sa.BigInteger(), nullable=False, server_default="0"
+        ),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+
+    # read_at is new, so no article has a time to read yet.
+    conn = op.get_bind()
+    backfill = sa.text(
+        """
+        WITH batch AS (
+            SELECT id FROM telegram_user WHERE id > :last_id ORDER BY id LIMIT :batch_size
+        ), inserted AS (
+            INSERT INTO user_stats (user_id, saved_count, read_count, unread_count)
+            SELECT b.id,
+                count(a.id),
+                count(a.id) FILTER (WHERE a.status = 'READ'),
+                count(a.id) FILTER (WHERE a.status = 'NEW')
+            FROM batch b LEFT JOIN article a ON a.user_id = b.id
+            GROUP BY b.id
+            ON CONFLICT (user_id) DO NOTHING
+        )
+        SELECT max(id) FROM batch
+        """
+    )
+    last_id = 0
+    # Commit every batch, see 3b1f6e2c9a47_add_article_preview.
+    with op.get_context().autocommit_block():
+        while True:
+            last_id = conn.execute(
+                backfill, last_id=last_id, batch_size=BATCH_SIZE
+            ).scalar()
+            if last_id is None:
+                break
+
+
+def downgrade():
+    op.drop_table("user_stats")
+    op.drop_column("article", "read_at")
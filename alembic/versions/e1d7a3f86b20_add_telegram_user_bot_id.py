@@ -0,0 +1,55 @@
+"""Add telegram_user bot_id
+
+Revision ID: e1d7a3f86b20
+Revises: c5a9e71d04f2
+Create Date: 2026-10-19 14:08:52.647015
+
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e1d7a3f86b20"
+down_revision = "c5a9e71d04f2"
+branch_labels = None
+depends_on = None
+
+
+def get_first_bot_id() -> int:
+    tokens = os.environ.get("TOKENS") or os.environ.get("TOKEN") or ""
+    token = tokens.split(",")[0].strip()
+    if not token:
+        raise RuntimeError("Set TOKEN or TOKENS to assign existing users to a bot")
+    return int(token.split(":", 1)[0])
+
+
+def upgrade():
+    op.add_column("telegram_user", sa.Column("bot_id", sa.types.BigInteger()))
+
+    # Users created so far all talked to the bot of the first token.
+    conn = op.get_bind()
+    if conn.execute(sa.text("SELECT EXISTS (SELECT 1 FROM telegram_user)")).scalar():
+        conn.execute(
+            sa.text("UPDATE telegram_user SET bot_id = :bot_id"),
+            bot_id=get_first_bot_id(),
+        )
+
+    op.alter_column("telegram_user", "bot_id", nullable=False)
+    op.drop_index("ix_telegram_user_telegram_id", table_name="telegram_user")
+    op.create_index(
+        "telegram_user_bot_id_telegram_id",
+        "telegram_user",
+        ["bot_id", "telegram_id"],
+        unique=True,
+    )
+
+
+def downgrade():
+    op.drop_index("telegram_user_bot_id_telegram_id", table_name="telegram_user")
+    op.create_index(
+        "ix_telegram_user_telegram_id", "telegram_user", ["telegram_id"], unique=True
+    )
+    op.drop_column("telegram_user", "bot_id")
@@ -1,30 +1,132 @@
 import logging
 import os
+import signal
 
-from typing import Dict
-from telegram.ext import Updater
-from bot.handlers import set_handlers
-from bot.db import get_db
+from queue import Queue
+from typing import Dict, List, Optional
+from prometheus_client import start_http_server
+from telegram.ext import CallbackContext, Updater
+from bot.handlers import BOTS, get_bot_id, send_reminders, set_handlers
+from bot.db import get_db, get_update_checkpoints
+from bot.dedup import CHECKPOINT_INTERVAL, deduplicator
+from bot.journal import journal, start_replayer
+from bot.profiling import profiler
+from bot.reminders import REMINDER_INTERVAL
 
 logger = logging.getLogger(__name__)
 
 
+class PollingUpdater(Updater):
+    """Updater that only polls, its updates go to another updater's
+    dispatcher. Its own dispatcher and job queue are never started, so an
+    extra bot costs a single polling thread."""
+
+    def start_polling(
+        self,
+        poll_interval: float = 0.0,
+        timeout: float = 10,
+        clean: bool = False,
+        bootstrap_retries: int = -1,
+        read_latency: float = 2.0,
+        allowed_updates: Optional[List[str]] = None,
+    ) -> Queue:
+        if not self.running:
+            self.running = True
+            self._init_thread(
+                self._start_polling,
+                "updater",
+                poll_interval,
+                timeout,
+                read_latency,
+                bootstrap_retries,
+                clean,
+                allowed_updates,
+            )
+        return self.update_queue
+
+
 def get_config() -> Dict:
     return {
-        "token": os.environ.get("TOKEN"),
+        "tokens": [
+            t.strip()
+            for t in (os.environ.get("TOKENS") or os.environ.get("TOKEN", "")).split(",")
+            if t.strip()
+        ],
+        "metrics_port": int(os.environ.get("METRICS_PORT", 8000)),
+        "admin_ids": [
+            int(i) for i in os.environ.get("ADMIN_IDS", "").split(",") if i.strip()
+        ],
+        "journal_path": os.environ.get("JOURNAL_PATH", "journal/bot.journal"),
+        "profile_sample_rate": int(os.environ.get("PROFILE_SAMPLE_RATE", 0)),
+        "profile_dir": os.environ.get("PROFILE_DIR", "profiles"),
+        "profile_dump_interval": int(os.environ.get("PROFILE_DUMP_INTERVAL", 600)),
     }
 
 
-def create_updater() -> Updater:
+def dump_profiles(context: CallbackContext) -> None:
+    profiler.dump()
+
+
+def checkpoint_updates(context: CallbackContext) -> None:
+    deduplicator.checkpoint()
+
+
+def setup_deduplicator(updaters: List[Updater]) -> None:
+    deduplicator.load(get_update_checkpoints())
+    for u in updaters:
+        high_water = deduplicator.high_water(get_bot_id(u.bot))
+        if high_water:
+            # Resume polling after the checkpoint instead of the backlog.
+            u.last_update_id = high_water + 1
+    updaters[0].job_queue.run_repeating(checkpoint_updates, CHECKPOINT_INTERVAL)
+
+
+def setup_profiler(updater: Updater, conf: Dict) -> None:
+    profiler.sample_rate = conf["profile_sample_rate"]
+    profiler.output_dir = conf["profile_dir"]
+    updater.job_queue.run_repeating(dump_profiles, conf["profile_dump_interval"])
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.dump())
+
+
+def create_updaters() -> List[Updater]:
+    """Create one updater per bot token. The first one owns the dispatcher,
+    its workers and job queue, the others are PollingUpdaters feeding the
+    shared dispatcher queue."""
     conf = get_config()
-    updater = Updater(conf["token"], use_context=True)
-    set_handlers(updater.dispatcher)
+    updater = Updater(conf["tokens"][0], use_context=True)
+    updaters = [updater]
+    for token in conf["tokens"][1:]:
+        extra = PollingUpdater(token, workers=0, use_context=True)
+        extra.update_queue = updater.dispatcher.update_queue
+        updaters.append(extra)
+
+    updater.dispatcher.bot_data[BOTS] = {get_bot_id(u.bot): u.bot for u in updaters}
+    set_handlers(updater.dispatcher, conf["admin_ids"])
     updater.dispatcher.db = get_db()
-    return updater
+    setup_deduplicator(updaters)
+    journal.open(conf["journal_path"])
+    start_replayer()
+    setup_profiler(updater, conf)
+    updater.job_queue.run_repeating(send_reminders, REMINDER_INTERVAL, first=0)
+    return updaters
 
 
 def run() -> None:
     logger.info('Starting up')
-    u = create_updater()
-    u.start_polling()
-    u.idle()
+    start_http_server(get_config()["metrics_port"])
+    updaters = create_updaters()
+    for u in updaters:
+        u.start_polling()
+
+    def stop(signum, frame):
+        logger.info("Received signal %s, stopping", signum)
+        # Stop polling before the shared dispatcher, so no fetched update is
+        # left unprocessed in its queue.
+        for u in reversed(updaters):
+            u.stop()
+        deduplicator.checkpoint(processed=True)
+        updaters[0].is_idle = False
+
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(sig, stop)
+    updaters[0].idle(stop_signals=())
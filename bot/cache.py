@@ -0,0 +1,135 @@
+import threading
+from collections import OrderedDict
+from itertools import count
+from typing import Any, Dict, Optional
+
+from prometheus_client import Counter, Gauge
+
+KEYBOARD_CACHE_SIZE = 4096
+READ_CACHE_SIZE = 16384
+
+CACHE_HITS = Counter("bot_cache_hits_total", "Cache hits", ["cache"])
+CACHE_MISSES = Counter("bot_cache_misses_total", "Cache misses", ["cache"])
+CACHE_SIZE = Gauge("bot_cache_size", "Number of cached entries", ["cache"])
+
+
+class KeyboardCache:
+    """LRU cache of rendered article keyboards keyed by user id. A user can
+    have several renders of the same list, one per keyboard ``kind``.
+
+    Every entry carries the version of the user's article list it was
+    rendered from. Writers call ``bump`` after changing the list, readers
+    take ``version`` before querying and ``put`` refuses to store a render
+    whose version is no longer current, so a slow reader can not overwrite
+    a newer invalidation with a stale keyboard.
+    """
+
+    def __init__(self, maxsize: int, name: str = "keyboard") -> None:
+        self.maxsize = maxsize
+        self.name = name
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, Any]" = OrderedDict()
+        self._clock = count(1)
+        self._floor = 0
+
+    def version(self, user_id: int) -> int:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            return entry[0] if entry is not None else self._floor
+
+    def get(self, user_id: int, kind: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            markup = entry[1].get(kind) if entry is not None else None
+            if markup is None:
+                CACHE_MISSES.labels(self.name).inc()
+                return None
+            self._entries.move_to_end(user_id)
+            CACHE_HITS.labels(self.name).inc()
+            return markup
+
+    def put(self, user_id: int, version: int, kind: str, markup: Any) -> bool:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            current = entry[0] if entry is not None else self._floor
+            if current != version:
+                return False
+            renders = dict(entry[1]) if entry is not None else {}
+            renders[kind] = markup
+            self._store(user_id, version, renders)
+            return True
+
+    def bump(self, user_id: int) -> None:
+        with self._lock:
+            self._store(user_id, next(self._clock), {})
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._floor = next(self._clock)
+            CACHE_SIZE.labels(self.name).set(0)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _store(self, user_id: int, version: int, renders: Dict[str, Any]) -> None:
+        self._entries[user_id] = (version, renders)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            # Users without an entry report the floor as their version, move
+            # it so renders started before the eviction are rejected.
+            self._floor = next(self._clock)
+        CACHE_SIZE.labels(self.name).set(len(self._entries))
+
+
+class LRUCache:
+    """Thread safe LRU mapping with hit/miss metrics."""
+
+    def __init__(self, maxsize: int, name: str) -> None:
+        self.maxsize = maxsize
+        self.name = name
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Any, Any]" = OrderedDict()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._entries:
+                CACHE_MISSES.labels(self.name).inc()
+                return default
+            self._entries.move_to_end(key)
+            CACHE_HITS.labels(self.name).inc()
+            return self._entries[key]
+
+    def peek(self, key: Any) -> Any:
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            CACHE_SIZE.labels(self.name).set(len(self._entries))
+
+    def pop(self, key: Any) -> Any:
+        with self._lock:
+            value = self._entries.pop(key, None)
+            CACHE_SIZE.labels(self.name).set(len(self._entries))
+            return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            CACHE_SIZE.labels(self.name).set(0)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+keyboard_cache = KeyboardCache(KEYBOARD_CACHE_SIZE)
+user_cache = LRUCache(READ_CACHE_SIZE, "user")
+settings_cache = LRUCache(READ_CACHE_SIZE, "settings")
+stats_cache = LRUCache(READ_CACHE_SIZE, "stats")
+articles_cache = LRUCache(READ_CACHE_SIZE, "articles")
@@ -1,32 +1,72 @@
+import json
 import logging
 import os
-from typing import Any, Dict, Optional, Tuple, List
+import threading
+from datetime import datetime, timezone
+from functools import wraps
+from typing import Any, Callable, Dict, Optional, Tuple, List
 
 from peewee import (
     SQL,
+    JOIN,
     BigIntegerField,
+    Case,
+    Cast,
     CharField,
+    Database,
+    DatabaseProxy,
     DateTimeField,
     DoesNotExist,
+    Field,
     ForeignKeyField,
     IntegerField,
     IntegrityError,
     DatabaseError,
     Model,
+    NodeList,
+    SqliteDatabase,
     TextField,
+    Value,
+    fn,
 )
 from playhouse.pool import PooledPostgresqlExtDatabase
-from playhouse.postgres_ext import BinaryJSONField
+
+from bot.cache import (
+    articles_cache,
+    keyboard_cache,
+    settings_cache,
+    stats_cache,
+    user_cache,
+)
+from bot.journal import DEFERRED, cached_read, journaled
+from bot.reminders import get_remind_at, reminder_scheduler
 
 logger = logging.getLogger(__name__)
 MAX_CONNECTIONS = 10
 STALE_TIMEOUT = 300
 
+BACKEND_POSTGRES = "postgres"
+BACKEND_SQLITE = "sqlite"
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "memory",
+    "foreign_keys": 1,
+    "busy_timeout": 5000,
+}
+
 ARTICLE_STATUS_NEW = "NEW"
 ARTICLE_STATUS_READ = "READ"
 ARTICLE_STATUSES = (ARTICLE_STATUS_NEW, ARTICLE_STATUS_READ)
 
-db = PooledPostgresqlExtDatabase(None)
+PREVIEW_LENGTH = 80
+
+STATS_REBUILD_BATCH_SIZE = 1000
+
+db = DatabaseProxy()
 
 
 def get_connection_params() -> Dict:
@@ -45,15 +85,107 @@ def get_connection_url() -> str:
     return url
 
 
-def get_db() -> PooledPostgresqlExtDatabase:
-    params = get_connection_params()
-    dbname = params.pop("dbname")
-    db.init(
-        dbname, max_connections=MAX_CONNECTIONS, stale_timeout=STALE_TIMEOUT, **params
-    )
+class MemorySqliteDatabase(SqliteDatabase):
+    """In-memory SQLite shared by all threads.
+
+    Every connection to ``:memory:`` opens its own empty database, so all
+    threads use one connection. Each thread keeps its own transaction
+    stack, and a lock lets only one transaction run at a time.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        kwargs["check_same_thread"] = False
+        super().__init__(*args, **kwargs)
+        self._serial = threading.RLock()
+        self._shared_conn = None
+
+    def _connect(self) -> Any:
+        with self._serial:
+            if self._shared_conn is None:
+                self._shared_conn = super()._connect()
+            return self._shared_conn
+
+    def _close(self, conn: Any) -> None:
+        # Closing the connection would drop the database.
+        pass
+
+    def begin(self, *args: Any, **kwargs: Any) -> None:
+        self._serial.acquire()
+        try:
+            super().begin(*args, **kwargs)
+        except BaseException:
+            self._serial.release()
+            raise
+
+    def pop_transaction(self) -> Any:
+        transaction = super().pop_transaction()
+        if not self.transaction_depth():
+            self._serial.release()
+        return transaction
+
+    def execute_sql(self, *args: Any, **kwargs: Any) -> Any:
+        with self._serial:
+            return super().execute_sql(*args, **kwargs)
+
+
+def get_backend() -> str:
+    return os.environ.get("DB_BACKEND", BACKEND_POSTGRES)
+
+
+def get_db() -> Database:
+    backend = get_backend()
+    if backend == BACKEND_SQLITE:
+        path = os.environ.get("SQLITE_PATH", "bot.sqlite3")
+        database_class = SqliteDatabase
+        if path == ":memory:":
+            database_class = MemorySqliteDatabase
+        db.initialize(database_class(path, pragmas=SQLITE_PRAGMAS))
+        create_schema()
+    elif backend == BACKEND_POSTGRES:
+        params = get_connection_params()
+        dbname = params.pop("dbname")
+        db.initialize(
+            PooledPostgresqlExtDatabase(
+                dbname,
+                max_connections=MAX_CONNECTIONS,
+                stale_timeout=STALE_TIMEOUT,
+                **params,
+            )
+        )
+    else:
+        raise ValueError(f"Unknown database backend {backend}")
     return db
 
 
+def is_sqlite() -> bool:
+    return isinstance(db.obj, SqliteDatabase)
+
+
+def write_atomic() -> Callable:
+    """``db.atomic()`` for transactions that write.
+
+    A deferred SQLite transaction that starts writing while another
+    connection writes fails with "database is locked" at once,
+    busy_timeout only applies to taking the write lock up front.
+    """
+
+    def decorator(f: Callable) -> Callable:
+        @wraps(f)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            lock_type = ("IMMEDIATE",) if is_sqlite() else ()
+            with db.atomic(*lock_type):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def create_schema() -> None:
+    """Create the tables for backends not managed by Alembic."""
+    db.create_tables(MODELS, safe=True)
+
+
 class EnumField(CharField):
     def __init__(self, choices: Tuple, *args: Any, **kwargs: Any) -> None:
         super(CharField, self).__init__(*args, **kwargs)
@@ -67,25 +199,44 @@ class EnumField(CharField):
         return value
 
 
+class JSONField(Field):
+    """JSON column stored as ``jsonb`` by the Alembic migrations and as
+    text on SQLite."""
+
+    field_type = "JSON"
+
+    def db_value(self, value: Any) -> Any:
+        return value if value is None else json.dumps(value)
+
+    def python_value(self, value: Any) -> Any:
+        # psycopg2 decodes jsonb itself, SQLite returns the raw text.
+        return json.loads(value) if isinstance(value, str) else value
+
+
 class BaseModel(Model):
     class Meta:
         database = db
 
 
 class TelegramUser(BaseModel):
-    created_at = DateTimeField(constraints=[SQL("DEFAULT now()")])
+    created_at = DateTimeField(constraints=[SQL("DEFAULT CURRENT_TIMESTAMP")])
     first_name = CharField()
-    telegram_id = BigIntegerField(unique=True)
-    context = BinaryJSONField(null=True)
+    bot_id = BigIntegerField()
+    telegram_id = BigIntegerField()
+    context = JSONField(null=True)
 
     class Meta:
         table_name = "telegram_user"
+        indexes = ((("bot_id", "telegram_id"), True),)
 
 
 class Article(BaseModel):
-    created_at = DateTimeField(constraints=[SQL("DEFAULT now()")], index=True)
+    created_at = DateTimeField(constraints=[SQL("DEFAULT CURRENT_TIMESTAMP")], index=True)
     status = EnumField(ARTICLE_STATUSES)
     text = TextField()
+    preview = CharField(max_length=PREVIEW_LENGTH)
+    remind_at = DateTimeField(null=True, index=True)
+    read_at = DateTimeField(null=True)
     user = ForeignKeyField(
         column_name="user_id", field="id", model=TelegramUser, backref="articles"
     )
@@ -111,51 +262,211 @@ class UserSettings(BaseModel):
         primary_key = False
 
 
+class UserStats(BaseModel):
+    user = ForeignKeyField(
+        column_name="user_id",
+        field="id",
+        model=TelegramUser,
+        primary_key=True,
+        backref="stats",
+    )
+    saved_count = IntegerField(default=0)
+    read_count = IntegerField(default=0)
+    unread_count = IntegerField(default=0)
+    # Articles read before read_at was recorded have no time to read.
+    timed_read_count = IntegerField(default=0)
+    read_seconds_total = BigIntegerField(default=0)
+
+    class Meta:
+        table_name = "user_stats"
+
+    @property
+    def read_rate(self) -> float:
+        return self.read_count / self.saved_count if self.saved_count else 0.0
+
+    @property
+    def avg_read_seconds(self) -> float:
+        if not self.timed_read_count:
+            return 0.0
+        return self.read_seconds_total / self.timed_read_count
+
+
+class UpdateCheckpoint(BaseModel):
+    bot_id = BigIntegerField(primary_key=True)
+    update_id = BigIntegerField()
+
+    class Meta:
+        table_name = "update_checkpoint"
+
+
+MODELS = [TelegramUser, Article, UserSettings, UserStats, UpdateCheckpoint]
+
+
+@cached_read(user_cache)
 @db.atomic()
-def get_telegram_user(telegram_id: int) -> Optional[TelegramUser]:
+def get_telegram_user(bot_id: int, telegram_id: int) -> Optional[TelegramUser]:
     try:
-        return TelegramUser.get(TelegramUser.telegram_id == telegram_id)
+        return TelegramUser.get(
+            (TelegramUser.bot_id == bot_id) & (TelegramUser.telegram_id == telegram_id)
+        )
     except DoesNotExist:
         return None
 
 
-@db.atomic()
+@write_atomic()
 def create_telegram_user(
-    telegram_id: int, first_name: str, context: Dict
+    bot_id: int, telegram_id: int, first_name: str, context: Dict
 ) -> Optional[TelegramUser]:
     try:
         return TelegramUser.create(
-            telegram_id=telegram_id, first_name=first_name, context=context
+            bot_id=bot_id,
+            telegram_id=telegram_id,
+            first_name=first_name,
+            context=context,
         )
     except IntegrityError as e:
         logger.error("Can not create user %s", e)
         return None
 
 
-@db.atomic()
-def update_telegram_user_context(
-    telegram_id: int, context: Dict
-) -> Optional[TelegramUser]:
+def get_telegram_user_id(bot_id: int, telegram_id: int) -> Optional[int]:
+    # User ids never change, a cached user is good enough.
+    cached = user_cache.peek((bot_id, telegram_id))
+    if cached is not None:
+        return cached.id
+    user = get_telegram_user(bot_id, telegram_id)
+    return user.id if user else None
+
+
+def update_telegram_user_context(bot_id: int, telegram_id: int, context: Dict) -> None:
+    cached = user_cache.peek((bot_id, telegram_id))
+    if cached is not None and cached.context is not None:
+        if all(cached.context.get(k) == v for k, v in context.items()):
+            return
     try:
-        user = get_telegram_user(telegram_id)
-        if user:
-            user.context.update(context)
-            user.save()
+        _update_telegram_user_context(bot_id, telegram_id, context)
     except DatabaseError as e:
-        logger.error("Can not update user %s", e)
-        return None
+        logger.error("Can not update user %s context %s", telegram_id, e)
+        return
+    if cached is not None and cached.context is not None:
+        cached.context.update(context)
 
 
-@db.atomic()
-def create_article(user: TelegramUser, text: str) -> Optional[Article]:
+# Journaled writes and cached reads leave errors of an unavailable database
+# to the decorators, which journal the write or serve the read from cache.
+
+
+@journaled("update_telegram_user_context")
+@write_atomic()
+def _update_telegram_user_context(bot_id: int, telegram_id: int, context: Dict) -> None:
+    TelegramUser.update(
+        context=json_merge(TelegramUser.context, context)
+    ).where(
+        (TelegramUser.bot_id == bot_id) & (TelegramUser.telegram_id == telegram_id)
+    ).execute()
+
+
+def utcnow() -> datetime:
+    now = datetime.now(timezone.utc)
+    # SQLite has no timezone aware type, CURRENT_TIMESTAMP is naive UTC.
+    return now.replace(tzinfo=None) if is_sqlite() else now
+
+
+def seconds_between(start: datetime, end: datetime) -> int:
+    return max(int((end - start).total_seconds()), 0)
+
+
+def seconds_between_sql(start: Field, end: Field) -> Any:
+    if is_sqlite():
+        seconds = (fn.julianday(end) - fn.julianday(start)) * 86400
+        return fn.MAX(Cast(seconds, "INTEGER"), 0)
+    seconds = fn.EXTRACT(NodeList((SQL("EPOCH FROM"), end - start)))
+    return fn.GREATEST(Cast(seconds, "BIGINT"), 0)
+
+
+def in_ids(field: Field, ids: List[int]) -> Any:
+    if is_sqlite():
+        return field.in_(ids)
+    return field == fn.ANY(Value(ids, converter=False, unpack=False))
+
+
+def json_merge(field: Field, value: Dict) -> Any:
+    """Merge ``value`` into the top level of a JSON column in SQL."""
+    data = Value(json.dumps(value), converter=False)
+    if is_sqlite():
+        return fn.json_patch(fn.COALESCE(field, "{}"), data)
+    return fn.COALESCE(field, Cast(Value("{}"), "jsonb")).concat(Cast(data, "jsonb"))
+
+
+def get_article_preview(text: str) -> str:
+    return text[:PREVIEW_LENGTH]
+
+
+def create_article(
+    user: TelegramUser, text: str, article_ttl_in_days: Optional[int] = None
+) -> Optional[Article]:
     try:
-        return Article.create(text=text, status=ARTICLE_STATUS_NEW, user_id=user.id)
+        article = _write_article(user.id, text, article_ttl_in_days)
     except DatabaseError as e:
         logger.error("Can not create article %s", e)
         return None
+    if article is DEFERRED:
+        article = Article(
+            user=user,
+            text=text,
+            preview=get_article_preview(text),
+            status=ARTICLE_STATUS_NEW,
+        )
+        # Counts towards the list size and duplicate checks until replayed.
+        _update_cached_articles(user.id, lambda articles: articles + [article])
+    return article
+
+
+@journaled("create_article")
+def _write_article(
+    user_id: int, text: str, article_ttl_in_days: Optional[int]
+) -> Optional[Article]:
+    remind_at = None
+    if article_ttl_in_days:
+        remind_at = get_remind_at(utcnow(), article_ttl_in_days)
+
+    article = _create_article(user_id, text, remind_at)
+    if article is not None:
+        keyboard_cache.bump(user_id)
+        _update_cached_articles(user_id, lambda articles: articles + [article])
+        if remind_at is not None:
+            reminder_scheduler.schedule(article.id, remind_at)
+    return article
+
+
+def _update_cached_articles(
+    user_id: int, update: Callable[[List[Article]], List[Article]]
+) -> None:
+    # Keeps the list served during an outage in step with writes.
+    cached = articles_cache.peek((user_id,))
+    if cached is not None:
+        articles_cache.put((user_id,), update(cached))
+
+
+@write_atomic()
+def _create_article(
+    user_id: int, text: str, remind_at: Optional[datetime]
+) -> Optional[Article]:
+    # Also makes journal replay of the same article a no-op.
+    if _article_exists(user_id, text):
+        return None
+    article = Article.create(
+        text=text,
+        preview=get_article_preview(text),
+        status=ARTICLE_STATUS_NEW,
+        user_id=user_id,
+        remind_at=remind_at,
+    )
+    _update_user_stats(user_id, saved=1, unread=1)
+    return article
 
 
-@db.atomic()
+@write_atomic()
 def create_user_settings(
     user: TelegramUser, reading_list_size: int, article_ttl_in_days: int
 ) -> Optional[UserSettings]:
@@ -170,36 +481,364 @@ def create_user_settings(
         return None
 
 
+@cached_read(settings_cache)
 @db.atomic()
-def get_user_articles(user_id: int, status: str = ARTICLE_STATUS_NEW) -> List[Article]:
+def get_user_settings(user_id: int) -> Optional[UserSettings]:
     try:
-        articles = Article.select().where(
-            (Article.user_id == user_id) & (Article.status == status)
+        return UserSettings.get(UserSettings.user == user_id)
+    except DoesNotExist:
+        return None
+
+
+@cached_read(articles_cache)
+@db.atomic()
+def get_user_articles(
+    user_id: int, status: str = ARTICLE_STATUS_NEW
+) -> Optional[List[Article]]:
+    articles = Article.select(Article.id, Article.preview).where(
+        (Article.user_id == user_id) & (Article.status == status)
+    )
+    return [a for a in articles]
+
+
+def user_article_exists(
+    user_id: int, text: str, status: str = ARTICLE_STATUS_NEW
+) -> bool:
+    exists = _user_article_exists(user_id, text, status)
+    if exists is not None:
+        return exists
+    # Database unavailable, check the cached list. Articles loaded for the
+    # list have only a preview, journaled ones also have their text.
+    cached = articles_cache.peek((user_id,)) if status == ARTICLE_STATUS_NEW else None
+    preview = get_article_preview(text)
+    return any(
+        a.text == text if a.text is not None else a.preview == preview
+        for a in cached or []
+    )
+
+
+@cached_read()
+@db.atomic()
+def _user_article_exists(user_id: int, text: str, status: str) -> Optional[bool]:
+    return _article_exists(user_id, text, status)
+
+
+def _article_exists(user_id: int, text: str, status: str = ARTICLE_STATUS_NEW) -> bool:
+    return (
+        Article.select(Article.id)
+        .where(
+            (Article.user_id == user_id)
+            & (Article.status == status)
+            & (Article.text == text)
         )
-        return [a for a in articles]
-    except DatabaseError as e:
-        logger.error("Can not get articles %s", e)
-        return []
+        .exists()
+    )
 
 
+@cached_read()
 @db.atomic()
-def get_article(article_id: int) -> Optional[Article]:
+def get_article(user_id: int, article_id: int) -> Optional[Article]:
     try:
-        return Article.get(Article.id == article_id)
+        return Article.get((Article.id == article_id) & (Article.user_id == user_id))
     except DoesNotExist:
         return None
 
 
+def update_article_status(user_id: int, article_id: int, status: str) -> Optional[int]:
+    return _set_articles_status(user_id, [article_id], status)
+
+
+def mark_articles_read(
+    user_id: int, article_ids: Optional[List[int]] = None
+) -> Optional[int]:
+    """Mark the given articles, or all of them if ``article_ids`` is None,
+    read in a single statement. Returns the number of updated articles, or
+    None if the update was journaled to be applied later."""
+    return _set_articles_status(user_id, article_ids, ARTICLE_STATUS_READ)
+
+
+def _set_articles_status(
+    user_id: int, article_ids: Optional[List[int]], status: str
+) -> Optional[int]:
+    try:
+        updated = _write_articles_status(user_id, article_ids, status)
+    except DatabaseError as e:
+        logger.error("Can not update articles %s status %s", article_ids, e)
+        return 0
+    return None if updated is DEFERRED else updated
+
+
+@journaled("update_articles_status")
+def _write_articles_status(
+    user_id: int, article_ids: Optional[List[int]], status: str
+) -> int:
+    updated = _update_articles_status(user_id, article_ids, status)
+    if updated:
+        keyboard_cache.bump(user_id)
+        if status != ARTICLE_STATUS_READ:
+            articles_cache.pop((user_id,))
+        elif article_ids is None:
+            _update_cached_articles(user_id, lambda articles: [])
+        else:
+            read = set(article_ids)
+            _update_cached_articles(
+                user_id, lambda articles: [a for a in articles if a.id not in read]
+            )
+        # Without ids the reminders are dropped when they come due, see
+        # get_reminder_articles.
+        reminder_scheduler.cancel(article_ids or [])
+    return updated
+
+
+@write_atomic()
+def _update_articles_status(
+    user_id: int, article_ids: Optional[List[int]], status: str
+) -> int:
+    where = (Article.user_id == user_id) & (Article.status != status)
+    if article_ids is not None:
+        where &= in_ids(Article.id, article_ids)
+    if status == ARTICLE_STATUS_READ:
+        return _read_articles(user_id, where)
+    return _unread_articles(user_id, where, status)
+
+
+def _read_articles(user_id: int, where: Any) -> int:
+    now = utcnow()
+    query = (
+        Article.update(
+            {
+                Article.status: ARTICLE_STATUS_READ,
+                Article.remind_at: None,
+                Article.read_at: now,
+            }
+        )
+        .where(where)
+        .returning(Article.created_at)
+    )
+    created = [created_at for (created_at,) in query.tuples()]
+    if created:
+        _update_user_stats(
+            user_id,
+            read=len(created),
+            unread=-len(created),
+            timed_reads=len(created),
+            read_seconds=sum(seconds_between(c, now) for c in created),
+        )
+    return len(created)
+
+
+def _unread_articles(user_id: int, where: Any, status: str) -> int:
+    # RETURNING only sees the cleared read_at, take the times to read off
+    # the stats from the rows as they were. Only rows the update actually
+    # changed are counted.
+    seconds = {
+        article_id: seconds_between(created_at, read_at)
+        for article_id, created_at, read_at in Article.select(
+            Article.id, Article.created_at, Article.read_at
+        )
+        .where(where)
+        .tuples()
+        if read_at is not None
+    }
+    query = (
+        Article.update({Article.status: status, Article.read_at: None})
+        .where(where)
+        .returning(Article.id)
+    )
+    updated = [article_id for (article_id,) in query.tuples()]
+    if updated:
+        timed = [seconds[i] for i in updated if i in seconds]
+        _update_user_stats(
+            user_id,
+            read=-len(updated),
+            unread=len(updated),
+            timed_reads=-len(timed),
+            read_seconds=-sum(timed),
+        )
+    return len(updated)
+
+
 @db.atomic()
-def update_article_status(
-    article_id: int, status: str
-) -> Optional[TelegramUser]:
+def get_articles_to_remind(
+    start: Optional[datetime], end: datetime
+) -> Optional[List[Tuple[int, datetime]]]:
+    try:
+        query = Article.select(Article.id, Article.remind_at).where(
+            Article.remind_at.is_null(False) & (Article.remind_at < end)
+        )
+        if start is not None:
+            query = query.where(Article.remind_at >= start)
+        return list(query.tuples())
+    except DatabaseError as e:
+        logger.error("Can not get articles to remind %s", e)
+        return None
+
+
+@db.atomic()
+def get_reminder_articles(
+    article_ids: List[int],
+) -> Optional[List[Tuple[int, str, int, int]]]:
     try:
-        article = get_article(article_id)
-        if article:
-            article.status = status
-            article.save()
-            return article
+        query = (
+            Article.select(
+                Article.id,
+                Article.preview,
+                TelegramUser.bot_id,
+                TelegramUser.telegram_id,
+            )
+            .join(TelegramUser)
+            .where(
+                in_ids(Article.id, article_ids)
+                & (Article.status == ARTICLE_STATUS_NEW)
+                & Article.remind_at.is_null(False)
+            )
+        )
+        return list(query.tuples())
     except DatabaseError as e:
-        logger.error("Can not update article %s status %s", article_id, e)
+        logger.error("Can not get reminder articles %s", e)
         return None
+
+
+@write_atomic()
+def clear_article_reminders(article_ids: List[int]) -> int:
+    try:
+        return (
+            Article.update(remind_at=None)
+            .where(in_ids(Article.id, article_ids))
+            .execute()
+        )
+    except DatabaseError as e:
+        logger.error("Can not clear reminders %s %s", article_ids, e)
+        return 0
+
+
+def _update_user_stats(
+    user_id: int,
+    saved: int = 0,
+    read: int = 0,
+    unread: int = 0,
+    timed_reads: int = 0,
+    read_seconds: int = 0,
+) -> None:
+    UserStats.insert(
+        user=user_id,
+        saved_count=saved,
+        read_count=read,
+        unread_count=unread,
+        timed_read_count=timed_reads,
+        read_seconds_total=read_seconds,
+    ).on_conflict(
+        conflict_target=[UserStats.user],
+        update={
+            UserStats.saved_count: UserStats.saved_count + saved,
+            UserStats.read_count: UserStats.read_count + read,
+            UserStats.unread_count: UserStats.unread_count + unread,
+            UserStats.timed_read_count: UserStats.timed_read_count + timed_reads,
+            UserStats.read_seconds_total: UserStats.read_seconds_total + read_seconds,
+        },
+    ).execute()
+
+
+@cached_read(stats_cache)
+@db.atomic()
+def get_user_stats(user_id: int) -> Optional[UserStats]:
+    try:
+        return UserStats.get(UserStats.user == user_id)
+    except DoesNotExist:
+        return None
+
+
+def rebuild_user_stats(batch_size: int = STATS_REBUILD_BATCH_SIZE) -> int:
+    last_id = 0
+    rebuilt = 0
+    while True:
+        user_ids = _rebuild_user_stats_batch(last_id, batch_size)
+        if not user_ids:
+            return rebuilt
+        last_id = user_ids[-1]
+        rebuilt += len(user_ids)
+        logger.info("Rebuilt stats for %s users", rebuilt)
+
+
+@write_atomic()
+def _rebuild_user_stats_batch(after_id: int, limit: int) -> List[int]:
+    user_ids = [
+        user_id
+        for (user_id,) in TelegramUser.select(TelegramUser.id)
+        .where(TelegramUser.id > after_id)
+        .order_by(TelegramUser.id)
+        .limit(limit)
+        .tuples()
+    ]
+    if not user_ids:
+        return []
+
+    if not is_sqlite():
+        # Writers update user_stats after inserting or updating the article,
+        # while these rows are locked they wait and their change is counted
+        # after the rebuild instead of being lost.
+        list(
+            UserStats.select(UserStats.user)
+            .where(in_ids(UserStats.user, user_ids))
+            .for_update()
+        )
+
+    is_read = Article.status == ARTICLE_STATUS_READ
+    is_timed = is_read & Article.read_at.is_null(False)
+    read_seconds = seconds_between_sql(Article.created_at, Article.read_at)
+    counts = (
+        TelegramUser.select(
+            TelegramUser.id,
+            fn.COUNT(Article.id),
+            fn.SUM(Case(None, [(is_read, 1)], 0)),
+            fn.SUM(Case(None, [(Article.status == ARTICLE_STATUS_NEW, 1)], 0)),
+            fn.SUM(Case(None, [(is_timed, 1)], 0)),
+            fn.SUM(Case(None, [(is_timed, read_seconds)], 0)),
+        )
+        .join(Article, JOIN.LEFT_OUTER, on=(Article.user == TelegramUser.id))
+        .where(in_ids(TelegramUser.id, user_ids))
+        .group_by(TelegramUser.id)
+    )
+    fields = [
+        UserStats.user,
+        UserStats.saved_count,
+        UserStats.read_count,
+        UserStats.unread_count,
+        UserStats.timed_read_count,
+        UserStats.read_seconds_total,
+    ]
+    UserStats.insert_from(counts, fields).on_conflict(
+        conflict_target=[UserStats.user], preserve=fields[1:]
+    ).execute()
+    return user_ids
+
+
+@db.atomic()
+def get_update_checkpoints() -> Dict[int, int]:
+    try:
+        return dict(
+            UpdateCheckpoint.select(
+                UpdateCheckpoint.bot_id, UpdateCheckpoint.update_id
+            ).tuples()
+        )
+    except DatabaseError as e:
+        logger.error("Can not get update checkpoints %s", e)
+        return {}
+
+
+@write_atomic()
+def save_update_checkpoints(checkpoints: Dict[int, int]) -> bool:
+    try:
+        UpdateCheckpoint.insert_many(
+            [
+                {"bot_id": bot_id, "update_id": update_id}
+                for bot_id, update_id in checkpoints.items()
+            ]
+        ).on_conflict(
+            conflict_target=[UpdateCheckpoint.bot_id],
+            preserve=[UpdateCheckpoint.update_id],
+        ).execute()
+        return True
+    except DatabaseError as e:
+        logger.error("Can not save update checkpoints %s", e)
+        return False
@@ -0,0 +1,131 @@
+import logging
+import threading
+from typing import Dict
+
+from prometheus_client import Counter
+
+from bot.db import save_update_checkpoints
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SIZE = 4096
+CHECKPOINT_EVERY = 100
+CHECKPOINT_INTERVAL = 10
+
+DUPLICATE_UPDATES = Counter(
+    "bot_duplicate_updates_total", "Redelivered updates dropped", ["bot"]
+)
+
+
+class UpdateWindow:
+    """Bitmap of the update ids seen in ``[base, base + size)``.
+
+    Telegram update ids grow monotonically per bot, so the window slides
+    forward as new ids arrive. Ids just below the window are treated as
+    already processed, ids further below mean the sequence was restarted
+    and start a new window.
+    """
+
+    def __init__(self, high_water: int = 0, size: int = WINDOW_SIZE) -> None:
+        self.size = size
+        self.high_water = high_water
+        self._base = high_water + 1
+        self._bits = 0
+
+    def seen(self, update_id: int) -> bool:
+        """Mark ``update_id`` as seen, return True if it was seen before."""
+        if update_id < self._base - self.size:
+            logger.warning(
+                "Update ids restarted at %s after %s", update_id, self.high_water
+            )
+            self.high_water = update_id - 1
+            self._base = update_id
+            self._bits = 0
+        if update_id < self._base:
+            return True
+
+        offset = update_id - self._base
+        if offset >= self.size:
+            shift = offset - self.size + 1
+            self._bits >>= shift
+            self._base += shift
+            offset -= shift
+
+        mask = 1 << offset
+        if self._bits & mask:
+            return True
+        self._bits |= mask
+        self.high_water = max(self.high_water, update_id)
+        return False
+
+
+class UpdateDeduplicator:
+    """Per bot windows of seen update ids with a high-water mark
+    checkpointed to the database every ``checkpoint_every`` updates.
+
+    The dispatcher handles updates one at a time, so when an update
+    arrives every update seen before it has been processed. Only that
+    high-water mark is checkpointed, never the one of the update being
+    handled.
+    """
+
+    def __init__(
+        self, window_size: int = WINDOW_SIZE, checkpoint_every: int = CHECKPOINT_EVERY
+    ) -> None:
+        self.window_size = window_size
+        self.checkpoint_every = checkpoint_every
+        self._lock = threading.Lock()
+        self._windows: Dict[int, UpdateWindow] = {}
+        self._processed: Dict[int, int] = {}
+        self._saved: Dict[int, int] = {}
+        self._since_checkpoint = 0
+
+    def load(self, checkpoints: Dict[int, int]) -> None:
+        with self._lock:
+            for bot_id, update_id in checkpoints.items():
+                self._windows[bot_id] = UpdateWindow(update_id, self.window_size)
+                self._processed[bot_id] = self._saved[bot_id] = update_id
+
+    def high_water(self, bot_id: int) -> int:
+        with self._lock:
+            window = self._windows.get(bot_id)
+            return window.high_water if window is not None else 0
+
+    def is_duplicate(self, bot_id: int, update_id: int) -> bool:
+        with self._lock:
+            self._mark_processed()
+            window = self._windows.get(bot_id)
+            if window is None:
+                window = self._windows[bot_id] = UpdateWindow(0, self.window_size)
+            duplicate = window.seen(update_id)
+            self._since_checkpoint += 1
+            checkpoint = self._since_checkpoint >= self.checkpoint_every
+
+        if duplicate:
+            DUPLICATE_UPDATES.labels(str(bot_id)).inc()
+        if checkpoint:
+            self.checkpoint()
+        return duplicate
+
+    def checkpoint(self, processed: bool = False) -> None:
+        """Save changed high-water marks. Pass ``processed`` once the
+        dispatcher is stopped and the last update has been handled too."""
+        with self._lock:
+            if processed:
+                self._mark_processed()
+            self._since_checkpoint = 0
+            changed = {
+                bot_id: update_id
+                for bot_id, update_id in self._processed.items()
+                if self._saved.get(bot_id) != update_id
+            }
+        if changed and save_update_checkpoints(changed):
+            with self._lock:
+                self._saved.update(changed)
+
+    def _mark_processed(self) -> None:
+        for bot_id, window in self._windows.items():
+            self._processed[bot_id] = window.high_water
+
+
+deduplicator = UpdateDeduplicator()
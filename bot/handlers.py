@@ -1,36 +1,68 @@
 import logging
 import re
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from datetime import datetime
 from enum import IntEnum, auto
 from functools import wraps
 from typing import Dict, List, Optional, Tuple
 
-from telegram import ReplyKeyboardMarkup, Update
+from telegram import (
+    Bot,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    ReplyKeyboardMarkup,
+    TelegramError,
+    Update,
+)
+from telegram.error import BadRequest, Unauthorized
+from prometheus_client import Counter
 from telegram.ext import (
     CallbackContext,
+    CallbackQueryHandler,
     CommandHandler,
     ConversationHandler,
     Dispatcher,
+    DispatcherHandlerStop,
     Filters,
     MessageHandler,
+    TypeHandler,
 )
 
+from bot.cache import keyboard_cache
+from bot.dedup import deduplicator
+from bot.profiling import profiler
+from bot.reminders import (
+    REMINDER_BATCH_SIZE,
+    REMINDER_RETRY_DELAY,
+    reminder_scheduler,
+)
 from bot.db import (
-    ARTICLE_STATUS_READ,
     Article,
     TelegramUser,
+    UserStats,
+    clear_article_reminders,
     create_article,
     create_telegram_user,
     create_user_settings,
     get_article,
+    get_articles_to_remind,
+    get_reminder_articles,
     get_telegram_user,
+    get_telegram_user_id,
     get_user_articles,
-    update_article_status,
+    get_user_settings,
+    get_user_stats,
+    mark_articles_read,
+    utcnow,
+    user_article_exists,
     update_telegram_user_context,
 )
 
 logger = logging.getLogger(__name__)
 
+UPDATES = Counter("bot_updates_total", "Updates received", ["bot"])
+UPDATE_ERRORS = Counter("bot_update_errors_total", "Updates failed with an error", ["bot"])
+
 SIZE_RE = re.compile("[0-9]{1,2}")
 
 MIN_LIST_SIZE = 3
@@ -65,18 +97,53 @@ ARTICLE_CANNOT_BE_EMPTY_MSG = "Article cannot be empty."
 
 ARTICLES_MSG = "Articles:"
 
+ARTICLES_MARKED_READ_MSG = "{} articles marked as read."
+
+ARTICLES_MARKED_READ_LATER_MSG = "Articles will be marked as read shortly."
+
+NO_ARTICLES_SELECTED_MSG = "Select articles first."
+
+STATS_MSG = """Saved: {saved}
+Read: {read}
+Unread: {unread}
+Read rate: {read_rate:.0%}
+Average time to read: {avg_read_hours:.1f} hours"""
+
+REMINDER_MSG = "These articles will soon leave your reading list:"
+
 ERROR_MSG = "Sorry, there was an error"
 
+PROFILE_RATE_MSG = "Profiling 1 in {} updates (0 means off)."
+
+PROFILE_DUMPED_MSG = "Dumped {} handler profiles."
+
+PROFILE_USAGE_MSG = "Usage: /profile [N|dump]"
+
 SHOW_COMMANDS_MSG = """You can execute the following commands:
 /start
 /add_article [text]
 /show_commands
 /show_articles
 /mark_articles
+/stats
 """
 
 days_keyboard = ReplyKeyboardMarkup(["3", "5", "7"], one_time_keyboard=True)
 
+ARTICLE_UNCHECKED = "\u2610"
+ARTICLE_CHECKED = "\u2611"
+
+CALLBACK_TOGGLE = "toggle"
+CALLBACK_MARK_SELECTED = "mark_selected"
+CALLBACK_MARK_ALL = "mark_all"
+CALLBACK_RE = f"^({CALLBACK_TOGGLE}:[0-9]+|{CALLBACK_MARK_SELECTED}|{CALLBACK_MARK_ALL})$"
+
+# Key of the bot id to Bot mapping in dispatcher.bot_data.
+BOTS = "bots"
+
+SHOW_KEYBOARD = "show"
+MARK_KEYBOARD = "mark"
+
 
 class State(IntEnum):
     WELCOME = auto()
@@ -86,8 +153,6 @@ class State(IntEnum):
     ADD_ARTICLE = auto()
     SHOW_ARTICLES = auto()
     SHOW_ARTICLE = auto()
-    MARK_ARTICLES = auto()
-    MARK_ARTICLE_READ = auto()
 
 
 Reply = namedtuple("Reply", ["msg", "reply_markup"])
@@ -131,12 +196,35 @@ def get_next_state(context: dict) -> State:
         return State.ADD_ARTICLE
     elif state == State.SHOW_ARTICLES:
         return State.SHOW_ARTICLE
-    elif state == State.MARK_ARTICLES:
-        return State.MARK_ARTICLE_READ
     else:
         return ConversationHandler.END
 
 
+def get_bot_id(bot: Bot) -> int:
+    return int(bot.token.split(":", 1)[0])
+
+
+def get_update_bot_id(update: Optional[Update]) -> Optional[int]:
+    if not isinstance(update, Update):
+        return None
+    # Chosen inline results and polls do not carry the bot.
+    for received in (
+        update.effective_message,
+        update.callback_query,
+        update.inline_query,
+        update.shipping_query,
+        update.pre_checkout_query,
+    ):
+        if received is not None and received.bot is not None:
+            return get_bot_id(received.bot)
+    return None
+
+
+def get_update_bot_label(update: Optional[Update]) -> str:
+    bot_id = get_update_bot_id(update)
+    return "unknown" if bot_id is None else str(bot_id)
+
+
 def log_error(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
@@ -149,18 +237,30 @@ def log_error(f):
     return wrapper
 
 
+def stop_propagation(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        f(*args, **kwargs)
+        raise DispatcherHandlerStop()
+
+    return wrapper
+
+
 def get_info_msg(user: TelegramUser) -> str:
-    articles = get_user_articles(user.id)
-    msg = f"Hello {user.first_name}! You have {len(articles)} unread articles. Type /show_commands for a list of commands."
+    stats = get_user_stats(user.id)
+    unread = stats.unread_count if stats else 0
+    msg = f"Hello {user.first_name}! You have {unread} unread articles. Type /show_commands for a list of commands."
     return msg
 
 
 @log_error
+@profiler.profile
 def welcome(update: Update, context: CallbackContext) -> State:
     logger.debug("welcome")
+    bot_id = get_bot_id(update.message.bot)
     telegram_id = update.message.from_user.id
     logger.debug("Telegram User %s", telegram_id)
-    user = get_telegram_user(telegram_id)
+    user = get_telegram_user(bot_id, telegram_id)
     logger.debug("User context %s", user.context if user else None)
     if user:
         next_state = get_next_state(user.context)
@@ -175,7 +275,10 @@ def welcome(update: Update, context: CallbackContext) -> State:
         return next_state
     else:
         user = create_telegram_user(
-            telegram_id, update.message.from_user.first_name, {"state": State.WELCOME}
+            bot_id,
+            telegram_id,
+            update.message.from_user.first_name,
+            {"state": State.WELCOME},
         )
         if user is None:
             return State.WELCOME
@@ -192,7 +295,9 @@ def get_list_size(msg: str) -> Optional[int]:
 
 
 @log_error
+@profiler.profile
 def waiting_for_list_size(update: Update, context: CallbackContext) -> State:
+    bot_id = get_bot_id(update.message.bot)
     telegram_id = update.message.from_user.id
     size = get_list_size(update.message.text)
     ctx = {}
@@ -204,7 +309,7 @@ def waiting_for_list_size(update: Update, context: CallbackContext) -> State:
         ctx.update(list_size=size)
 
     ctx.update(state=state)
-    update_telegram_user_context(telegram_id, ctx)
+    update_telegram_user_context(bot_id, telegram_id, ctx)
     msg, reply_kwargs = get_state_msg(state)
     update.message.reply_text(msg, **reply_kwargs)
     return state
@@ -218,14 +323,16 @@ def get_article_ttl(msg: str) -> int:
 
 
 @log_error
+@profiler.profile
 def waiting_for_artilce_ttl(update: Update, context: CallbackContext) -> State:
+    bot_id = get_bot_id(update.message.bot)
     telegram_id = update.message.from_user.id
     article_ttl = get_article_ttl(update.message.text)
     ctx = {}
     state = State.WAITING_FOR_ARTILCE_TTL
 
     if article_ttl:
-        user = get_telegram_user(telegram_id)
+        user = get_telegram_user(bot_id, telegram_id)
         list_size = user.context.get(LIST_SIZE)
         if list_size is None:
             update.message.reply_text(ERROR_MSG)
@@ -240,7 +347,7 @@ def waiting_for_artilce_ttl(update: Update, context: CallbackContext) -> State:
         ctx.update(article_ttl=article_ttl, settings_provided=True)
 
     ctx.update(state=state)
-    update_telegram_user_context(telegram_id, ctx)
+    update_telegram_user_context(bot_id, telegram_id, ctx)
     msg, reply_kwargs = get_state_msg(state)
     update.message.reply_text(msg, **reply_kwargs)
     return state
@@ -255,7 +362,10 @@ def get_article_text(msg: str) -> str:
 
 def check_and_create_article(user: TelegramUser, update: Update) -> (str, State):
     articles = get_user_articles(user.id)
-    settings = user.settings[0]
+    settings = get_user_settings(user.id)
+    if articles is None or settings is None:
+        # Database unavailable and nothing cached to check the list size.
+        return ERROR_MSG, State.ADD_ARTICLE
     if len(articles) >= settings.reading_list_size:
         return LIST_IS_FULL_MSG, State.WELCOME
 
@@ -265,11 +375,12 @@ def check_and_create_article(user: TelegramUser, update: Update) -> (str, State)
 
     new_article_text = new_article_text.strip()
 
-    old_article = [a for a in articles if a.text == new_article_text]
-    if len(old_article) > 0:
+    if user_article_exists(user.id, new_article_text):
         return ARTICLE_ALREADY_EXISTS_MSG, State.WELCOME
 
-    article = create_article(user, new_article_text)
+    article = create_article(
+        user, new_article_text, settings.article_ttl_in_days
+    )
     if article is None:
         return ERROR_MSG, State.ADD_ARTICLE
 
@@ -277,9 +388,11 @@ def check_and_create_article(user: TelegramUser, update: Update) -> (str, State)
 
 
 @log_error
+@profiler.profile
 def add_article(update: Update, context: CallbackContext) -> State:
+    bot_id = get_bot_id(update.message.bot)
     telegram_id = update.message.from_user.id
-    user = get_telegram_user(telegram_id)
+    user = get_telegram_user(bot_id, telegram_id)
     state = State.WELCOME
     msg = None
     ctx = {}
@@ -292,45 +405,174 @@ def add_article(update: Update, context: CallbackContext) -> State:
         msg, state = check_and_create_article(user, update)
 
     ctx.update(state=state)
-    update_telegram_user_context(telegram_id, ctx)
+    update_telegram_user_context(bot_id, telegram_id, ctx)
     msg = msg or ERROR_MSG
     update.message.reply_text(msg)
     return state
 
 
 @log_error
+@profiler.profile
 def show_commands(update: Update, context: CallbackContext) -> State:
     logger.debug("show_commands")
     update.message.reply_text(SHOW_COMMANDS_MSG)
     return ConversationHandler.END
 
 
+@log_error
+@profiler.profile
+def stats(update: Update, context: CallbackContext) -> State:
+    user = get_telegram_user(
+        get_bot_id(update.message.bot), update.message.from_user.id
+    )
+    user_stats = (get_user_stats(user.id) if user else None) or UserStats()
+    update.message.reply_text(
+        STATS_MSG.format(
+            saved=user_stats.saved_count,
+            read=user_stats.read_count,
+            unread=user_stats.unread_count,
+            read_rate=user_stats.read_rate,
+            avg_read_hours=user_stats.avg_read_seconds / 3600,
+        )
+    )
+    return ConversationHandler.END
+
+
 def get_articles_keyboard(articles: List[Article]) -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
-        [[f"{a.id} {a.text[:80]}"] for a in articles], one_time_keyboard=True
+        [[f"{a.id} {a.preview}"] for a in articles], one_time_keyboard=True
+    )
+
+
+def get_mark_articles_keyboard(articles: List[Article]) -> InlineKeyboardMarkup:
+    buttons = [
+        [
+            InlineKeyboardButton(
+                f"{ARTICLE_UNCHECKED} {a.preview}",
+                callback_data=f"{CALLBACK_TOGGLE}:{a.id}",
+            )
+        ]
+        for a in articles
+    ]
+    buttons.append(
+        [
+            InlineKeyboardButton(
+                "Mark selected read", callback_data=CALLBACK_MARK_SELECTED
+            ),
+            InlineKeyboardButton("Mark all read", callback_data=CALLBACK_MARK_ALL),
+        ]
     )
+    return InlineKeyboardMarkup(buttons)
+
+
+KEYBOARDS = {
+    SHOW_KEYBOARD: get_articles_keyboard,
+    MARK_KEYBOARD: get_mark_articles_keyboard,
+}
+
 
+def get_user_keyboard(user_id: int, kind: str):
+    reply_markup = keyboard_cache.get(user_id, kind)
+    if reply_markup is None:
+        version = keyboard_cache.version(user_id)
+        articles = get_user_articles(user_id)
+        # Journaled articles have no id to show or select until replayed.
+        saved = [a for a in articles or [] if a.id is not None]
+        reply_markup = KEYBOARDS[kind](saved)
+        if articles is not None:
+            keyboard_cache.put(user_id, version, kind, reply_markup)
+    return reply_markup
 
-def _show_articles(update: Update, state: State) -> None:
+
+def _show_articles(update: Update, state: State, kind: str) -> None:
+    bot_id = get_bot_id(update.message.bot)
     telegram_id = update.message.from_user.id
-    user = get_telegram_user(telegram_id)
-    articles = get_user_articles(user.id)
-    reply_markup = get_articles_keyboard(articles)
+    user_id = get_telegram_user_id(bot_id, telegram_id)
+    if user_id is None:
+        logger.error("User not found by id: %s", telegram_id)
+        update.message.reply_text(ERROR_MSG)
+        return ConversationHandler.END
+
+    reply_markup = get_user_keyboard(user_id, kind)
 
-    update_telegram_user_context(telegram_id, {"state": state})
+    update_telegram_user_context(bot_id, telegram_id, {"state": state})
 
     update.message.reply_text(ARTICLES_MSG, reply_markup=reply_markup)
     return state
 
 
 @log_error
+@profiler.profile
 def show_articles(update: Update, context: CallbackContext) -> State:
-    return _show_articles(update, State.SHOW_ARTICLE)
+    return _show_articles(update, State.SHOW_ARTICLE, SHOW_KEYBOARD)
 
 
 @log_error
+@profiler.profile
 def mark_articles(update: Update, context: CallbackContext) -> State:
-    return _show_articles(update, State.MARK_ARTICLE_READ)
+    return _show_articles(update, State.WELCOME, MARK_KEYBOARD)
+
+
+def toggle_article(
+    reply_markup: InlineKeyboardMarkup, callback_data: str
+) -> InlineKeyboardMarkup:
+    buttons = []
+    for row in reply_markup.inline_keyboard:
+        new_row = []
+        for button in row:
+            text = button.text
+            if button.callback_data == callback_data:
+                mark, _, preview = text.partition(" ")
+                mark = ARTICLE_UNCHECKED if mark == ARTICLE_CHECKED else ARTICLE_CHECKED
+                text = f"{mark} {preview}"
+            new_row.append(
+                InlineKeyboardButton(text, callback_data=button.callback_data)
+            )
+        buttons.append(new_row)
+    return InlineKeyboardMarkup(buttons)
+
+
+def get_selected_article_ids(reply_markup: InlineKeyboardMarkup) -> List[int]:
+    prefix = f"{CALLBACK_TOGGLE}:"
+    return [
+        int(button.callback_data[len(prefix) :])
+        for row in reply_markup.inline_keyboard
+        for button in row
+        if button.callback_data.startswith(prefix)
+        and button.text.startswith(ARTICLE_CHECKED)
+    ]
+
+
+@log_error
+@profiler.profile
+def mark_articles_callback(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    if query.data.startswith(CALLBACK_TOGGLE):
+        query.edit_message_reply_markup(
+            reply_markup=toggle_article(query.message.reply_markup, query.data)
+        )
+        query.answer()
+        return
+
+    user = get_telegram_user(get_bot_id(query.message.bot), query.from_user.id)
+    if user is None:
+        logger.error("User not found by id: %s", query.from_user.id)
+        query.answer(ERROR_MSG)
+        return
+
+    article_ids = None
+    if query.data == CALLBACK_MARK_SELECTED:
+        article_ids = get_selected_article_ids(query.message.reply_markup)
+        if not article_ids:
+            query.answer(NO_ARTICLES_SELECTED_MSG)
+            return
+
+    updated = mark_articles_read(user.id, article_ids)
+    query.answer()
+    if updated is None:
+        query.edit_message_text(ARTICLES_MARKED_READ_LATER_MSG)
+    else:
+        query.edit_message_text(ARTICLES_MARKED_READ_MSG.format(updated))
 
 
 def get_article_id(text: str) -> Optional[int]:
@@ -341,46 +583,138 @@ def get_article_id(text: str) -> Optional[int]:
 
 
 @log_error
+@profiler.profile
 def show_article(update: Update, context: CallbackContext) -> State:
+    bot_id = get_bot_id(update.message.bot)
     telegram_id = update.message.from_user.id
     article_id = get_article_id(update.message.text)
 
-    if article_id is not None:
-        article = get_article(article_id)
+    user_id = get_telegram_user_id(bot_id, telegram_id)
+    if article_id is not None and user_id is not None:
+        article = get_article(user_id, article_id)
         logger.debug("Found article with id %s", article_id)
         if article:
             update.message.reply_text(article.text)
         else:
             logger.error("Article not found: id %s", article_id)
 
-    update_telegram_user_context(telegram_id, {"state": State.WELCOME})
+    update_telegram_user_context(bot_id, telegram_id, {"state": State.WELCOME})
     return State.WELCOME
 
 
+@stop_propagation
 @log_error
-def mark_article_read(update: Update, context: CallbackContext) -> State:
-    telegram_id = update.message.from_user.id
-    article_id = get_article_id(update.message.text)
+def profile(update: Update, context: CallbackContext) -> None:
+    if not context.args:
+        update.message.reply_text(PROFILE_RATE_MSG.format(profiler.sample_rate))
+    elif context.args[0] == "dump":
+        paths = profiler.dump()
+        update.message.reply_text(PROFILE_DUMPED_MSG.format(len(paths)))
+    else:
+        try:
+            rate = int(context.args[0])
+        except ValueError:
+            rate = -1
+        if rate < 0:
+            update.message.reply_text(PROFILE_USAGE_MSG)
+            return
+        profiler.sample_rate = rate
+        update.message.reply_text(PROFILE_RATE_MSG.format(rate))
+
+
+def send_reminders(context: CallbackContext) -> None:
+    now = utcnow()
+    window = reminder_scheduler.next_load(now)
+    if window is not None:
+        reminder_scheduler.loaded(get_articles_to_remind(*window))
+
+    retry = []
+    try:
+        while True:
+            due = reminder_scheduler.pop_due(now, REMINDER_BATCH_SIZE)
+            if not due:
+                return
+
+            articles = get_reminder_articles([article_id for article_id, _ in due])
+            if articles is None:
+                retry.extend(due)
+                return
+
+            retry.extend(_send_reminders(context, articles, now))
+    finally:
+        # Requeued after the loop, so they are not popped again right away.
+        reminder_scheduler.requeue(retry)
+
+
+def _send_reminders(
+    context: CallbackContext,
+    articles: List[Tuple[int, str, int, int]],
+    now: datetime,
+) -> List[Tuple[int, datetime]]:
+    reminders = defaultdict(list)
+    for article_id, preview, bot_id, telegram_id in articles:
+        reminders[(bot_id, telegram_id)].append((article_id, preview))
+
+    bots = context.dispatcher.bot_data.get(BOTS, {})
+    done, retry = [], []
+    for (bot_id, telegram_id), user_reminders in reminders.items():
+        article_ids = [article_id for article_id, _ in user_reminders]
+        bot = bots.get(bot_id)
+        if bot is None:
+            # Left in the database for a process that serves this bot.
+            logger.error("Unknown bot %s for reminder to %s", bot_id, telegram_id)
+            continue
+        text = "\n".join([REMINDER_MSG] + [preview for _, preview in user_reminders])
+        try:
+            bot.send_message(telegram_id, text)
+        except (BadRequest, Unauthorized) as e:
+            # The user blocked the bot or the chat is gone, retrying will
+            # not help.
+            logger.error("Can not send reminder to %s %s", telegram_id, e)
+        except TelegramError as e:
+            logger.error("Will retry reminder to %s %s", telegram_id, e)
+            retry.extend((i, now + REMINDER_RETRY_DELAY) for i in article_ids)
+            continue
+        done.extend(article_ids)
 
-    if article_id is not None:
-        update_article_status(article_id, ARTICLE_STATUS_READ)
+    if done and not clear_article_reminders(done):
+        logger.error("Reminders %s were not cleared and may be sent again", done)
+    return retry
 
-    update_telegram_user_context(telegram_id, {"state": State.WELCOME})
-    return State.WELCOME
+
+def drop_duplicate_update(update: Update, context: CallbackContext) -> None:
+    bot_id = get_update_bot_id(update)
+    if bot_id is not None and deduplicator.is_duplicate(bot_id, update.update_id):
+        logger.info("Dropping duplicate update %s of bot %s", update.update_id, bot_id)
+        raise DispatcherHandlerStop()
+
+
+def count_update(update: Update, context: CallbackContext) -> None:
+    UPDATES.labels(get_update_bot_label(update)).inc()
 
 
 def error(update: Update, context: CallbackContext) -> None:
+    UPDATE_ERRORS.labels(get_update_bot_label(update)).inc()
     logger.error('Update "%s" caused error "%s"', update, context.error)
 
 
+class BotConversationHandler(ConversationHandler):
+    """Conversation keyed by bot as well, so a user talking to several of
+    the hosted bots has a separate conversation with each."""
+
+    def _get_key(self, update: Update) -> Tuple:
+        return (get_update_bot_id(update),) + super()._get_key(update)
+
+
 def get_conversation_handler() -> ConversationHandler:
-    return ConversationHandler(
+    return BotConversationHandler(
         entry_points=[
             CommandHandler("start", welcome),
             CommandHandler("add_article", add_article),
             CommandHandler("show_commands", show_commands),
             CommandHandler("show_articles", show_articles),
             CommandHandler("mark_articles", mark_articles),
+            CommandHandler("stats", stats),
         ],
         states={
             State.WELCOME: [MessageHandler(Filters.all, welcome)],
@@ -393,12 +727,21 @@ def get_conversation_handler() -> ConversationHandler:
             State.ADD_ARTICLE: [MessageHandler(Filters.text, add_article)],
             State.SHOW_COMMANDS: [MessageHandler(Filters.all, show_commands)],
             State.SHOW_ARTICLE: [MessageHandler(Filters.text, show_article)],
-            State.MARK_ARTICLE_READ: [MessageHandler(Filters.text, mark_article_read)],
         },
         fallbacks=[CommandHandler("start", show_commands)],
     )
 
 
-def set_handlers(dp: Dispatcher):
+def set_handlers(dp: Dispatcher, admin_ids: List[int] = None):
+    dp.add_handler(TypeHandler(Update, drop_duplicate_update), group=-3)
+    dp.add_handler(TypeHandler(Update, count_update), group=-2)
+    if admin_ids:
+        # Runs before the conversation and stops there, so admin commands
+        # work in any conversation state without being handled twice.
+        dp.add_handler(
+            CommandHandler("profile", profile, filters=Filters.user(user_id=admin_ids)),
+            group=-1,
+        )
     dp.add_handler(get_conversation_handler())
+    dp.add_handler(CallbackQueryHandler(mark_articles_callback, pattern=CALLBACK_RE))
     dp.add_error_handler(error)
@@ -0,0 +1,376 @@
+import json
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from peewee import InterfaceError, OperationalError
+from prometheus_client import Counter, Gauge
+
+from bot.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+FAILURE_THRESHOLD = 5
+SLOW_CALL_SECONDS = 1.0
+RESET_TIMEOUT = 30.0
+REPLAY_BATCH_SIZE = 100
+REPLAY_INTERVAL = 1.0
+
+BREAKER_CLOSED = 0
+BREAKER_OPEN = 1
+BREAKER_HALF_OPEN = 2
+
+BREAKER_STATE = Gauge(
+    "bot_db_breaker_state", "Database circuit breaker state, 0 closed 1 open 2 half open"
+)
+JOURNAL_DEPTH = Gauge("bot_journal_depth", "Journaled writes waiting for replay")
+JOURNAL_REPLAY_LAG = Gauge(
+    "bot_journal_replay_lag_seconds", "Age of the oldest journaled write not replayed"
+)
+JOURNAL_WRITES = Counter("bot_journal_writes_total", "Writes sent to the journal", ["op"])
+JOURNAL_REPLAYED = Counter("bot_journal_replayed_total", "Journaled writes replayed", ["op"])
+JOURNAL_DROPPED = Counter(
+    "bot_journal_dropped_total", "Journaled writes dropped because replay failed", ["op"]
+)
+
+# Result of a write that was journaled instead of applied.
+DEFERRED = object()
+
+# Errors of an unavailable database. InterfaceError is raised for pooled
+# connections the server has closed. Other database errors, e.g. an
+# IntegrityError, come from the write itself and would fail again on replay.
+DATABASE_ERRORS = (OperationalError, InterfaceError)
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failed or slow database
+    calls. While open, calls fail fast. After ``reset_timeout`` a single
+    probe call is let through. If it succeeds the breaker closes, if it
+    fails the breaker opens again."""
+
+    def __init__(
+        self,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        slow_call_seconds: float = SLOW_CALL_SECONDS,
+        reset_timeout: float = RESET_TIMEOUT,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = BREAKER_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._state != BREAKER_CLOSED
+
+    def allow_request(self) -> bool:
+        if self._state == BREAKER_CLOSED:
+            return True
+        with self._lock:
+            if self._state == BREAKER_OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._set_state(BREAKER_HALF_OPEN)
+            if self._state == BREAKER_HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def record_success(self, duration: float) -> None:
+        if duration > self.slow_call_seconds:
+            logger.warning("Slow database call %.3fs", duration)
+            self.record_failure()
+            return
+        if self._state == BREAKER_CLOSED and not self._failures:
+            return
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            if self._state != BREAKER_CLOSED:
+                logger.info("Database recovered, closing circuit breaker")
+                self._set_state(BREAKER_CLOSED)
+
+    def release_probe(self) -> None:
+        """Let the next call probe again when the last one ended without
+        recording a result, e.g. on an error unrelated to the database."""
+        if self._probing:
+            with self._lock:
+                self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == BREAKER_HALF_OPEN or (
+                self._state == BREAKER_CLOSED
+                and self._failures >= self.failure_threshold
+            ):
+                logger.error("Opening database circuit breaker")
+                self._opened_at = time.monotonic()
+                self._set_state(BREAKER_OPEN)
+
+    def _set_state(self, state: int) -> None:
+        self._state = state
+        BREAKER_STATE.set(state)
+
+
+class WriteJournal:
+    """Append-only file of writes made while the database is unavailable.
+
+    Every record is a JSON line. ``append`` returns once the record is
+    fsynced, a background thread syncs all records appended since its last
+    fsync at once. Replay progress is kept in ``<path>.offset`` and the
+    file is truncated when everything has been replayed.
+    """
+
+    def __init__(self) -> None:
+        self.path: Optional[str] = None
+        self._cond = threading.Condition()
+        self._file = None
+        self._offset = 0
+        self._written = 0
+        self._synced = 0
+        self._depth = 0
+        self._seq = 0
+        self._synced_seq = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._file is not None
+
+    @property
+    def pending(self) -> bool:
+        return self._offset < self._written
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    @property
+    def offset_path(self) -> str:
+        return f"{self.path}.offset"
+
+    def open(self, path: str) -> None:
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with open(path, "ab+") as f:
+            f.seek(0)
+            data = f.read()
+            # Drop a record cut short by a crash, it was never acknowledged.
+            end = data.rfind(b"\n") + 1
+            if end != len(data):
+                f.truncate(end)
+
+        try:
+            with open(self.offset_path) as f:
+                self._offset = min(int(f.read()), end)
+        except (OSError, ValueError):
+            self._offset = 0
+
+        self._file = open(path, "ab")
+        self._written = self._synced = end
+        self._depth = data.count(b"\n", self._offset, end)
+        JOURNAL_DEPTH.set(self._depth)
+        if self._depth:
+            logger.warning("Journal %s has %s writes to replay", path, self._depth)
+
+        threading.Thread(target=self._sync_loop, name="journal", daemon=True).start()
+
+    def append(self, op: str, args: List, kwargs: Dict) -> None:
+        line = json.dumps({"op": op, "args": args, "kwargs": kwargs, "ts": time.time()})
+        data = line.encode() + b"\n"
+        with self._cond:
+            self._file.write(data)
+            self._written += len(data)
+            self._depth += 1
+            self._seq += 1
+            seq = self._seq
+            self._cond.notify_all()
+            while self._synced_seq < seq:
+                self._cond.wait()
+        JOURNAL_DEPTH.set(self._depth)
+        JOURNAL_WRITES.labels(op).inc()
+
+    def _sync_loop(self) -> None:
+        while True:
+            with self._cond:
+                while self._synced_seq == self._seq:
+                    self._cond.wait()
+                seq, written = self._seq, self._written
+                self._file.flush()
+                fd = self._file.fileno()
+            os.fsync(fd)
+            with self._cond:
+                self._synced_seq = seq
+                self._synced = written
+                self._cond.notify_all()
+
+    def read_batch(self, limit: int) -> List[Tuple[Dict, int]]:
+        """Return up to ``limit`` synced records after the replay offset,
+        each with the offset just past it."""
+        with self._cond:
+            start, end = self._offset, self._synced
+
+        records = []
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            position = start
+            while len(records) < limit and position < end:
+                line = f.readline()
+                position += len(line)
+                records.append((json.loads(line), position))
+        return records
+
+    def commit(self, offset: int, count: int) -> None:
+        with self._cond:
+            self._offset = offset
+            self._depth -= count
+            if self._offset == self._written and self._synced_seq == self._seq:
+                self._file.seek(0)
+                self._file.truncate()
+                self._offset = self._written = self._synced = 0
+                if os.path.exists(self.offset_path):
+                    os.remove(self.offset_path)
+            else:
+                tmp_path = f"{self.offset_path}.tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(str(offset))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.offset_path)
+            depth = self._depth
+        JOURNAL_DEPTH.set(depth)
+
+
+breaker = CircuitBreaker()
+journal = WriteJournal()
+
+APPLIERS: Dict[str, Callable] = {}
+
+
+def journaled(op: str) -> Callable:
+    """Run a database write, or append it to the journal when the database
+    is unavailable or older writes are still waiting for replay. Journaled
+    calls return ``DEFERRED``, other errors are raised to the caller.
+    Arguments must be JSON serializable and applying the same write twice
+    must be harmless, replay after a crash can repeat the last batch."""
+
+    def decorator(f: Callable) -> Callable:
+        APPLIERS[op] = f
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not journal.is_open:
+                return f(*args, **kwargs)
+            if journal.pending or not breaker.allow_request():
+                journal.append(op, list(args), kwargs)
+                return DEFERRED
+
+            start = time.monotonic()
+            try:
+                result = f(*args, **kwargs)
+            except DATABASE_ERRORS as e:
+                breaker.record_failure()
+                logger.error("Journaling %s after database error %s", op, e)
+                journal.append(op, list(args), kwargs)
+                return DEFERRED
+            finally:
+                breaker.release_probe()
+            breaker.record_success(time.monotonic() - start)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def cached_read(cache: Optional[LRUCache] = None, default: Any = None) -> Callable:
+    """Run a database read through the circuit breaker. Results are kept in
+    ``cache`` and served from it when the database is unavailable."""
+
+    def decorator(f: Callable) -> Callable:
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if breaker.allow_request():
+                start = time.monotonic()
+                try:
+                    result = f(*args, **kwargs)
+                except DATABASE_ERRORS as e:
+                    breaker.record_failure()
+                    logger.error("Serving %s from cache after database error %s", f.__name__, e)
+                else:
+                    breaker.record_success(time.monotonic() - start)
+                    if cache is not None and result is not None:
+                        cache.put(args, result)
+                    return result
+                finally:
+                    breaker.release_probe()
+            return cache.get(args, default) if cache is not None else default
+
+        return wrapper
+
+    return decorator
+
+
+def replay(batch_size: int = REPLAY_BATCH_SIZE) -> int:
+    replayed = 0
+    while journal.pending:
+        batch = journal.read_batch(batch_size)
+        if not batch or not breaker.allow_request():
+            break
+
+        JOURNAL_REPLAY_LAG.set(time.time() - batch[0][0]["ts"])
+        offset, count = None, 0
+        try:
+            for record, end in batch:
+                start = time.monotonic()
+                try:
+                    APPLIERS[record["op"]](*record["args"], **record["kwargs"])
+                except DATABASE_ERRORS:
+                    raise
+                except Exception as e:
+                    logger.exception("Dropping journaled write %s %s", record, e)
+                    JOURNAL_DROPPED.labels(record["op"]).inc()
+                else:
+                    breaker.record_success(time.monotonic() - start)
+                    JOURNAL_REPLAYED.labels(record["op"]).inc()
+                offset, count = end, count + 1
+        except DATABASE_ERRORS as e:
+            breaker.record_failure()
+            logger.error("Journal replay stopped %s", e)
+            break
+        finally:
+            breaker.release_probe()
+            if offset is not None:
+                journal.commit(offset, count)
+                replayed += count
+
+    if not journal.pending:
+        JOURNAL_REPLAY_LAG.set(0)
+    return replayed
+
+
+def start_replayer(interval: float = REPLAY_INTERVAL) -> threading.Thread:
+    def run() -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                if replay():
+                    logger.info("Replayed journal, %s writes left", journal.depth)
+            except Exception as e:
+                logger.exception("Journal replay failed %s", e)
+
+    thread = threading.Thread(target=run, name="journal-replay", daemon=True)
+    thread.start()
+    return thread
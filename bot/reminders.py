@@ -0,0 +1,92 @@
+import heapq
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+REMIND_BEFORE = timedelta(days=1)
+REMINDER_WINDOW = timedelta(hours=1)
+REMINDER_INTERVAL = 60
+REMINDER_BATCH_SIZE = 100
+REMINDER_RETRY_DELAY = timedelta(minutes=5)
+
+
+def get_remind_at(created_at: datetime, article_ttl_in_days: int) -> datetime:
+    ttl = timedelta(days=article_ttl_in_days)
+    return created_at + ttl - min(REMIND_BEFORE, ttl / 2)
+
+
+class ReminderScheduler:
+    """Min-heap of reminder due times for the near-term window.
+
+    Only reminders due before ``now + window`` are kept in memory. The
+    window is extended by ``next_load`` / ``loaded`` with range queries on
+    ``article.remind_at``, reminders created inside the already loaded
+    window are pushed by ``schedule``. Cancelled entries are dropped lazily
+    when they reach the top of the heap.
+    """
+
+    def __init__(self, window: timedelta = REMINDER_WINDOW) -> None:
+        self.window = window
+        self._lock = threading.Lock()
+        self._heap: List[Tuple[datetime, int]] = []
+        self._due: Dict[int, datetime] = {}
+        self._loaded_until: Optional[datetime] = None
+        self._loading_until: Optional[datetime] = None
+
+    def schedule(self, article_id: int, due: datetime) -> None:
+        with self._lock:
+            horizon = self._loading_until or self._loaded_until
+            if horizon is not None and due < horizon:
+                self._push(article_id, due)
+
+    def cancel(self, article_ids: Iterable[int]) -> None:
+        with self._lock:
+            for article_id in article_ids:
+                self._due.pop(article_id, None)
+
+    def next_load(self, now: datetime) -> Optional[Tuple[Optional[datetime], datetime]]:
+        """Return the ``[start, end)`` range to load, ``start`` is None on the
+        first load so reminders missed while the bot was down are picked up."""
+        with self._lock:
+            if self._loading_until is not None:
+                return None
+            if self._loaded_until is not None and self._loaded_until > now + self.window / 2:
+                return None
+            self._loading_until = now + self.window
+            return self._loaded_until, self._loading_until
+
+    def loaded(self, reminders: Optional[List[Tuple[int, datetime]]]) -> None:
+        with self._lock:
+            if reminders is not None:
+                for article_id, due in reminders:
+                    self._push(article_id, due)
+                self._loaded_until = self._loading_until
+            self._loading_until = None
+
+    def pop_due(self, now: datetime, limit: int) -> List[Tuple[int, datetime]]:
+        due_reminders = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and len(due_reminders) < limit:
+                due, article_id = heapq.heappop(self._heap)
+                if self._due.get(article_id) != due:
+                    continue
+                del self._due[article_id]
+                due_reminders.append((article_id, due))
+        return due_reminders
+
+    def requeue(self, reminders: List[Tuple[int, datetime]]) -> None:
+        with self._lock:
+            for article_id, due in reminders:
+                self._push(article_id, due)
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def _push(self, article_id: int, due: datetime) -> None:
+        if self._due.get(article_id) == due:
+            return
+        self._due[article_id] = due
+        heapq.heappush(self._heap, (due, article_id))
+
+
+reminder_scheduler = ReminderScheduler()
@@ -2,6 +2,7 @@ import argparse
 import logging
 import logging.config
 from bot.app import run
+from bot.db import get_db, rebuild_user_stats
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +18,12 @@ if __name__ == "__main__":
         choices=["DEBUG", "INFO", "WARNINGS", "ERROR"],
         help="Log level",
     )
+    parser.add_argument(
+        "--rebuild-stats",
+        action="store_true",
+        dest="rebuild_stats",
+        help="Recompute user_stats from articles and exit",
+    )
 
     args = parser.parse_args()
     logging.basicConfig(
@@ -24,4 +31,8 @@ if __name__ == "__main__":
         level=args.loglevel,
     )
 
-    run()
+    if args.rebuild_stats:
+        get_db()
+        rebuild_user_stats()
+    else:
+        run()
@@ -0,0 +1,188 @@
+import itertools
+import queue
+import warnings
+
+import pytest
+
+warnings.filterwarnings("ignore", message="python-telegram-bot is using upstream urllib3")
+
+from telegram import Bot, InlineKeyboardMarkup, Update, User  # noqa: E402
+from telegram.ext import Dispatcher  # noqa: E402
+
+from bot import cache, db, dedup, handlers, journal, reminders  # noqa: E402
+
+TOKEN = "123:abc"
+ADMIN_ID = 7
+
+
+class FakeBot(Bot):
+    """Bot that records what it would send to Telegram."""
+
+    def __init__(self, token: str = TOKEN) -> None:
+        super().__init__(token)
+        self.bot = User(handlers.get_bot_id(self), "Bot", True, username="test_bot")
+        self.sent = []
+        self.answers = []
+        self.markups = {}
+        self._message_ids = itertools.count(1)
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        message_id = next(self._message_ids)
+        self.sent.append((chat_id, text, reply_markup))
+        self.markups[message_id] = reply_markup
+        return message_id
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.answers.append(text)
+
+    answerCallbackQuery = answer_callback_query
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.sent.append((chat_id, text, None))
+        self.markups[message_id] = None
+
+    def edit_message_reply_markup(
+        self, chat_id=None, message_id=None, reply_markup=None, **kwargs
+    ):
+        self.markups[message_id] = reply_markup
+
+
+class Client:
+    """A Telegram user talking to one bot through the dispatcher."""
+
+    def __init__(
+        self, dp: Dispatcher, bot: FakeBot, update_ids, telegram_id: int = 42
+    ) -> None:
+        self.dp = dp
+        self.bot = bot
+        self.update_ids = update_ids
+        self.telegram_id = telegram_id
+
+    @property
+    def user(self) -> dict:
+        return {"id": self.telegram_id, "is_bot": False, "first_name": "Ann"}
+
+    def send(self, text: str) -> str:
+        message = {
+            "message_id": 1,
+            "date": 0,
+            "text": text,
+            "chat": {"id": self.telegram_id, "type": "private"},
+            "from": self.user,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(command)}
+            ]
+        return self.process({"message": message})
+
+    def press(self, data: str, message_id: int = None) -> str:
+        """Press an inline button of the last, or the given, message."""
+        if message_id is None:
+            message_id = self.last_message_id
+        markup = self.bot.markups[message_id]
+        message = {
+            "message_id": message_id,
+            "date": 0,
+            "chat": {"id": self.telegram_id, "type": "private"},
+            "reply_markup": markup.to_dict() if markup else None,
+        }
+        query = {"id": "1", "from": self.user, "chat_instance": "1", "data": data}
+        query["message"] = message
+        return self.process({"callback_query": query})
+
+    def process(self, data: dict) -> str:
+        data["update_id"] = next(self.update_ids)
+        self.dp.process_update(Update.de_json(data, self.bot))
+        return self.last_text
+
+    @property
+    def last_text(self) -> str:
+        return self.bot.sent[-1][1] if self.bot.sent else None
+
+    @property
+    def last_markup(self):
+        return self.bot.markups.get(self.last_message_id)
+
+    @property
+    def last_message_id(self) -> int:
+        return max(self.bot.markups) if self.bot.markups else None
+
+    def inline_buttons(self, message_id: int = None):
+        markup = self.bot.markups[message_id or self.last_message_id]
+        assert isinstance(markup, InlineKeyboardMarkup)
+        return [button for row in markup.inline_keyboard for button in row]
+
+    def register(self, list_size: int = 5, ttl: int = 3) -> None:
+        """Register and leave the conversation waiting for an article."""
+        self.send("/start")
+        self.send(str(list_size))
+        self.send(str(ttl))
+
+    def add_article(self, text: str) -> str:
+        """Add an article and end the conversation, return the reply."""
+        reply = self.send(f"/add_article {text}")
+        self.send("/start")
+        return reply
+
+
+@pytest.fixture(autouse=True)
+def database(monkeypatch):
+    monkeypatch.setenv("DB_BACKEND", db.BACKEND_SQLITE)
+    monkeypatch.setenv("SQLITE_PATH", ":memory:")
+    for c in (
+        cache.user_cache,
+        cache.settings_cache,
+        cache.stats_cache,
+        cache.articles_cache,
+    ):
+        c.clear()
+    cache.keyboard_cache.clear()
+    scheduler = reminders.ReminderScheduler()
+    monkeypatch.setattr(db, "reminder_scheduler", scheduler)
+    monkeypatch.setattr(handlers, "reminder_scheduler", scheduler)
+    monkeypatch.setattr(handlers, "deduplicator", dedup.UpdateDeduplicator())
+    monkeypatch.setattr(journal, "breaker", journal.CircuitBreaker())
+    monkeypatch.setattr(journal, "journal", journal.WriteJournal())
+    return db.get_db()
+
+
+@pytest.fixture
+def statements(monkeypatch, database):
+    """SQL statements run against the database, in order."""
+    executed = []
+    execute_sql = database.obj.execute_sql
+
+    def recording_execute_sql(sql, *args, **kwargs):
+        executed.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+
+    monkeypatch.setattr(database.obj, "execute_sql", recording_execute_sql)
+    return executed
+
+
+@pytest.fixture
+def bot():
+    return FakeBot()
+
+
+@pytest.fixture
+def dispatcher(bot):
+    dp = Dispatcher(bot, queue.Queue(), workers=0, use_context=True)
+    dp.bot_data[handlers.BOTS] = {handlers.get_bot_id(bot): bot}
+    handlers.set_handlers(dp, [ADMIN_ID])
+    errors = []
+    dp.add_error_handler(lambda update, context: errors.append(context.error))
+    yield dp
+    assert not errors
+
+
+@pytest.fixture
+def update_ids():
+    return itertools.count(1)
+
+
+@pytest.fixture
+def client(dispatcher, bot, update_ids):
+    return Client(dispatcher, bot, update_ids)
@@ -0,0 +1,30 @@
+import threading
+import time
+from queue import Queue
+
+from telegram import Update, User
+
+from bot.app import PollingUpdater
+
+
+def test_polling_updater_starts_only_a_polling_thread(monkeypatch):
+    updater = PollingUpdater("456:def", workers=0, use_context=True)
+    updater.update_queue = Queue()
+    batches = [[Update(5), Update(6)]]
+
+    def get_updates(offset=None, **kwargs):
+        time.sleep(0.01)
+        return batches.pop() if batches else []
+
+    updater.bot.bot = User(456, "Bot", True, username="other_bot")
+    monkeypatch.setattr(updater.bot, "delete_webhook", lambda: True)
+    monkeypatch.setattr(updater.bot, "get_updates", get_updates)
+
+    threads = threading.active_count()
+    updater.start_polling(timeout=0)
+    assert [updater.update_queue.get(timeout=1).update_id for _ in range(2)] == [5, 6]
+    assert threading.active_count() == threads + 1
+    assert updater.last_update_id == 7
+
+    updater.stop()
+    assert threading.active_count() == threads
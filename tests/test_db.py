@@ -0,0 +1,100 @@
+import threading
+from datetime import timedelta
+
+from bot import db
+
+
+def create_user(telegram_id=42, bot_id=123):
+    return db.create_telegram_user(bot_id, telegram_id, "Ann", {"state": 1})
+
+
+def get_stats(user):
+    return db.UserStats.get(db.UserStats.user == user.id)
+
+
+def test_memory_database_is_shared_between_threads():
+    users = [create_user(telegram_id=i) for i in range(4)]
+    errors = []
+
+    def write(user):
+        try:
+            for i in range(50):
+                db.create_article(user, f"article {i}")
+                if i % 10 == 9:
+                    db.mark_articles_read(user.id)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(u,)) for u in users]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    assert db.Article.select().count() == 200
+    for user in users:
+        stats = get_stats(user)
+        assert (stats.saved_count, stats.read_count + stats.unread_count) == (50, 50)
+
+
+def test_only_writes_take_the_sqlite_write_lock(statements):
+    user = create_user()
+    db.get_user_articles(user.id)
+    db.create_article(user, "article")
+
+    begins = [sql for sql in statements if sql.startswith("BEGIN")]
+    assert begins == ["BEGIN IMMEDIATE", "BEGIN", "BEGIN IMMEDIATE"]
+
+
+def test_create_article_sets_preview_and_stats():
+    user = create_user()
+    article = db.create_article(user, "x" * 200, article_ttl_in_days=3)
+    assert article.preview == "x" * db.PREVIEW_LENGTH
+    assert article.remind_at is not None
+    assert db.create_article(user, "x" * 200) is None
+
+    stats = get_stats(user)
+    assert (stats.saved_count, stats.unread_count) == (1, 1)
+
+
+def test_average_time_to_read_skips_untimed_reads():
+    user = create_user()
+    old = db.create_article(user, "read before read_at")
+    new = db.create_article(user, "read in ten hours")
+    db.Article.update(status=db.ARTICLE_STATUS_READ).where(
+        db.Article.id == old.id
+    ).execute()
+    db.rebuild_user_stats()
+    db.Article.update(created_at=db.utcnow() - timedelta(hours=10)).where(
+        db.Article.id == new.id
+    ).execute()
+
+    assert db.mark_articles_read(user.id, [new.id]) == 1
+    stats = get_stats(user)
+    assert (stats.read_count, stats.timed_read_count) == (2, 1)
+    assert round(stats.avg_read_seconds / 3600) == 10
+
+
+def test_unread_articles_take_back_time_to_read():
+    user = create_user()
+    article = db.create_article(user, "article")
+    db.mark_articles_read(user.id, [article.id])
+
+    assert db.update_article_status(user.id, article.id, db.ARTICLE_STATUS_NEW) == 1
+    assert db.update_article_status(user.id, article.id, db.ARTICLE_STATUS_NEW) == 0
+    stats = get_stats(user)
+    assert (stats.read_count, stats.unread_count, stats.timed_read_count) == (0, 1, 0)
+    assert stats.read_seconds_total == 0
+
+
+def test_rebuild_user_stats_matches_incremental_stats():
+    user = create_user()
+    for i in range(3):
+        db.create_article(user, f"article {i}")
+    db.mark_articles_read(user.id, [db.Article.get(text="article 0").id])
+    incremental = get_stats(user).__data__
+
+    db.UserStats.delete().execute()
+    assert db.rebuild_user_stats(batch_size=1) == 1
+    assert get_stats(user).__data__ == incremental
@@ -0,0 +1,138 @@
+import pytest
+from telegram import Update
+
+from bot import db, dedup, handlers
+
+from conftest import FakeBot
+
+
+def test_window_marks_ids_seen():
+    window = dedup.UpdateWindow(100, size=8)
+    assert window.seen(100)
+    assert not window.seen(101)
+    assert window.seen(101)
+    assert not window.seen(103)
+    assert not window.seen(102)
+    assert window.high_water == 103
+
+
+def test_window_slides_forward():
+    window = dedup.UpdateWindow(0, size=8)
+    assert not window.seen(3)
+    assert not window.seen(20)
+    # Ids that fell out of the window count as seen.
+    assert window.seen(5)
+    assert not window.seen(13)
+    assert window.seen(13)
+    assert window.high_water == 20
+
+
+def test_window_restarts_when_ids_go_far_back():
+    window = dedup.UpdateWindow(10000, size=8)
+    assert window.seen(9995)
+    assert not window.seen(5)
+    assert window.high_water == 5
+    assert window.seen(5)
+    assert not window.seen(6)
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    checkpoints = []
+
+    def save(changed):
+        checkpoints.append(dict(changed))
+        return True
+
+    monkeypatch.setattr(dedup, "save_update_checkpoints", save)
+    return checkpoints
+
+
+def test_checkpoint_saves_only_processed_updates(saved):
+    deduplicator = dedup.UpdateDeduplicator(checkpoint_every=3)
+    for update_id in (1, 2):
+        assert not deduplicator.is_duplicate(123, update_id)
+    assert saved == []
+
+    # Update 3 is being handled, only 2 is known to be processed.
+    assert not deduplicator.is_duplicate(123, 3)
+    assert saved == [{123: 2}]
+
+    deduplicator.checkpoint(processed=True)
+    assert saved == [{123: 2}, {123: 3}]
+    deduplicator.checkpoint(processed=True)
+    assert len(saved) == 2
+
+
+def test_duplicates_are_counted_per_bot(saved):
+    deduplicator = dedup.UpdateDeduplicator()
+    assert not deduplicator.is_duplicate(123, 1)
+    assert not deduplicator.is_duplicate(456, 1)
+    assert deduplicator.is_duplicate(123, 1)
+    deduplicator.checkpoint(processed=True)
+    assert saved == [{123: 1, 456: 1}]
+
+
+def test_failed_checkpoint_is_retried(monkeypatch):
+    results = [False, True]
+    saved = []
+
+    def save(changed):
+        saved.append(dict(changed))
+        return results.pop(0)
+
+    monkeypatch.setattr(dedup, "save_update_checkpoints", save)
+    deduplicator = dedup.UpdateDeduplicator()
+    deduplicator.is_duplicate(123, 7)
+    deduplicator.checkpoint(processed=True)
+    deduplicator.checkpoint(processed=True)
+    assert saved == [{123: 7}, {123: 7}]
+
+
+def test_resume_from_checkpoint():
+    deduplicator = dedup.UpdateDeduplicator()
+    deduplicator.is_duplicate(123, 41)
+    deduplicator.is_duplicate(123, 42)
+    deduplicator.checkpoint(processed=True)
+
+    restarted = dedup.UpdateDeduplicator()
+    restarted.load(db.get_update_checkpoints())
+    assert restarted.high_water(123) == 42
+    assert restarted.is_duplicate(123, 42)
+    assert not restarted.is_duplicate(123, 43)
+    assert restarted.high_water(456) == 0
+
+
+def test_redelivered_update_is_dropped(client, bot):
+    client.register()
+    client.update_ids = iter([100, 100])
+    client.send("article")
+    client.send("article")
+    assert [text for _, text, _ in bot.sent].count(handlers.ARTICLE_CREATED_MSG) == 1
+    assert db.Article.select().count() == 1
+
+
+def test_bot_of_callback_query_on_inline_message():
+    update = Update.de_json(
+        {
+            "update_id": 1,
+            "callback_query": {
+                "id": "1",
+                "from": {"id": 42, "is_bot": False, "first_name": "Ann"},
+                "chat_instance": "1",
+                "inline_message_id": "abc",
+                "data": handlers.CALLBACK_MARK_ALL,
+            },
+        },
+        FakeBot(),
+    )
+    assert handlers.get_update_bot_id(update) == 123
+    assert handlers.get_update_bot_label(update) == "123"
+
+
+def test_restarted_ids_are_checkpointed(saved):
+    deduplicator = dedup.UpdateDeduplicator()
+    deduplicator.load({123: 10000})
+    assert not deduplicator.is_duplicate(123, 5)
+    deduplicator.checkpoint(processed=True)
+    assert saved == [{123: 5}]
@@ -0,0 +1,192 @@
+from bot import db, handlers
+
+from conftest import ADMIN_ID, Client, FakeBot
+
+
+def get_user(telegram_id=42):
+    return db.TelegramUser.get(db.TelegramUser.telegram_id == telegram_id)
+
+
+def test_registration(client):
+    assert client.send("/start").startswith(handlers.WELCOME_MSG)
+    assert client.send("5") == handlers.ASK_FOR_ITEM_TTL_MSG
+    assert client.send("3") == handlers.ASK_FOR_ARTICLE_MSG
+
+    settings = db.UserSettings.get(db.UserSettings.user == get_user().id)
+    assert (settings.reading_list_size, settings.article_ttl_in_days) == (5, 3)
+    assert get_user().context["settings_provided"]
+
+
+def test_invalid_list_size_is_asked_again(client):
+    client.send("/start")
+    assert client.send("42") == handlers.ASK_FOR_LIST_SIZE_MSG
+    assert client.send("4") == handlers.ASK_FOR_ITEM_TTL_MSG
+
+
+def test_add_article(client):
+    client.register()
+    assert client.send("first article") == handlers.ARTICLE_CREATED_MSG
+    client.send("/start")
+    assert client.add_article("second article") == handlers.ARTICLE_CREATED_MSG
+
+    articles = db.Article.select().order_by(db.Article.id)
+    assert [a.text for a in articles] == ["first article", "second article"]
+    assert client.send("/start").startswith("Hello Ann! You have 2 unread articles.")
+
+
+def test_add_article_rejects_duplicates_and_full_list(client):
+    client.register(list_size=3)
+    client.add_article("article 1")
+    assert client.add_article("article 1") == handlers.ARTICLE_ALREADY_EXISTS_MSG
+    client.add_article("article 2")
+    client.add_article("article 3")
+    assert client.add_article("article 4") == handlers.LIST_IS_FULL_MSG
+    assert db.Article.select().count() == 3
+
+
+def test_show_articles(client):
+    client.register()
+    text = "x" * (db.PREVIEW_LENGTH + 20)
+    client.add_article(text)
+
+    assert client.send("/show_articles") == handlers.ARTICLES_MSG
+    ((button,),) = client.last_markup.keyboard
+    article_id = db.Article.get().id
+    assert button == f"{article_id} {text[:db.PREVIEW_LENGTH]}"
+
+    assert client.send(button) == text
+
+
+def test_repeat_show_articles_uses_cached_keyboard(client, statements):
+    client.register()
+    client.add_article("article")
+    client.send("/show_articles")
+    first = client.last_markup
+    # Leave SHOW_ARTICLE, then WELCOME.
+    client.send("/start")
+    client.send("/start")
+
+    statements.clear()
+    client.send("/show_articles")
+    assert client.last_markup is first
+    # Only the conversation state is written, nothing is read.
+    writes = [sql for sql in statements if not sql.startswith("BEGIN")]
+    assert len(writes) == 1
+    assert writes[0].startswith('UPDATE "telegram_user" SET "context" = ')
+
+    client.send("/start")
+    client.send("/start")
+    client.add_article("another")
+    client.send("/show_articles")
+    assert len(client.last_markup.keyboard) == 2
+
+
+def test_mark_selected_articles_read(client):
+    client.register()
+    for i in range(3):
+        client.add_article(f"article {i}")
+
+    client.send("/mark_articles")
+    toggles = [b.callback_data for b in client.inline_buttons()][:3]
+    client.press(toggles[0])
+    client.press(toggles[2])
+    checked = [
+        b.text
+        for b in client.inline_buttons()
+        if b.text.startswith(handlers.ARTICLE_CHECKED)
+    ]
+    assert checked == [
+        f"{handlers.ARTICLE_CHECKED} article 0",
+        f"{handlers.ARTICLE_CHECKED} article 2",
+    ]
+
+    assert client.press(handlers.CALLBACK_MARK_SELECTED) == (
+        handlers.ARTICLES_MARKED_READ_MSG.format(2)
+    )
+    unread = db.Article.select().where(db.Article.status == db.ARTICLE_STATUS_NEW)
+    assert [a.text for a in unread] == ["article 1"]
+
+
+def test_mark_selected_requires_selection(client, bot):
+    client.register()
+    client.add_article("article")
+    client.send("/mark_articles")
+    client.press(handlers.CALLBACK_MARK_SELECTED)
+    assert bot.answers[-1] == handlers.NO_ARTICLES_SELECTED_MSG
+
+
+def test_mark_all_articles_read(client):
+    client.register()
+    client.add_article("article 1")
+    client.add_article("article 2")
+    client.send("/mark_articles")
+    assert client.press(handlers.CALLBACK_MARK_ALL) == (
+        handlers.ARTICLES_MARKED_READ_MSG.format(2)
+    )
+    client.send("/start")
+    assert client.send("/start").startswith("Hello Ann! You have 0 unread articles.")
+
+
+def test_mark_articles_read_only_touches_own_articles(
+    client, dispatcher, bot, update_ids
+):
+    client.register()
+    client.add_article("mine")
+    other = Client(dispatcher, bot, update_ids, telegram_id=43)
+    other.register()
+    other.add_article("theirs")
+
+    mine = db.Article.get(text="mine").id
+    assert db.mark_articles_read(get_user(43).id, [mine]) == 0
+    assert db.mark_articles_read(get_user(43).id, None) == 1
+    assert db.Article.get(text="mine").status == db.ARTICLE_STATUS_NEW
+
+
+def test_show_article_only_shows_own_articles(client, dispatcher, bot, update_ids):
+    client.register()
+    client.add_article("mine")
+    other = Client(dispatcher, bot, update_ids, telegram_id=43)
+    other.register()
+    other.add_article("theirs")
+    other.send("/show_articles")
+
+    other.send(f"{db.Article.get(text='mine').id} mine")
+    assert "mine" not in [sent[1] for sent in bot.sent]
+
+
+def test_stats(client):
+    client.register()
+    client.add_article("article 1")
+    client.add_article("article 2")
+    client.send("/mark_articles")
+    client.press(client.inline_buttons()[0].callback_data)
+    client.press(handlers.CALLBACK_MARK_SELECTED)
+    client.send("/start")
+
+    assert client.send("/stats").startswith(
+        "Saved: 2\nRead: 1\nUnread: 1\nRead rate: 50%"
+    )
+
+
+def test_profile_is_not_saved_as_article(dispatcher, bot, update_ids):
+    admin = Client(dispatcher, bot, update_ids, telegram_id=ADMIN_ID)
+    admin.register()
+    assert admin.send("/profile") == handlers.PROFILE_RATE_MSG.format(0)
+    assert admin.send("/profile dump") == handlers.PROFILE_DUMPED_MSG.format(0)
+    assert db.Article.select().count() == 0
+
+
+def test_conversations_are_kept_per_bot(client, dispatcher, update_ids):
+    other_bot = FakeBot("456:def")
+    dispatcher.bot_data[handlers.BOTS][456] = other_bot
+    other = Client(dispatcher, other_bot, update_ids)
+
+    client.register()
+    other.register()
+    other.add_article("on the other bot")
+    assert other.send("/show_articles") == handlers.ARTICLES_MSG
+    assert client.send("on this bot") == handlers.ARTICLE_CREATED_MSG
+
+    users = {u.bot_id: u.id for u in db.TelegramUser.select()}
+    articles = {a.text: a.user_id for a in db.Article.select()}
+    assert articles == {"on the other bot": users[456], "on this bot": users[123]}
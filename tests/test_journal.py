@@ -0,0 +1,175 @@
+import pytest
+from peewee import IntegrityError, OperationalError
+
+from bot import db, handlers, journal
+
+
+@pytest.fixture
+def outage(monkeypatch, database):
+    """Fail every statement but BEGIN while ``outage["down"]`` is set, like
+    a restarted server behind already open pooled connections."""
+    state = {"down": False}
+    execute_sql = database.obj.execute_sql
+
+    def failing_execute_sql(sql, *args, **kwargs):
+        if state["down"] and not sql.startswith("BEGIN"):
+            raise OperationalError("server closed the connection unexpectedly")
+        return execute_sql(sql, *args, **kwargs)
+
+    monkeypatch.setattr(database.obj, "execute_sql", failing_execute_sql)
+    return state
+
+
+@pytest.fixture
+def write_journal(tmp_path):
+    journal.journal.open(str(tmp_path / "bot.journal"))
+    return journal.journal
+
+
+def test_writes_are_journaled_and_replayed(client, outage, write_journal):
+    client.register()
+    client.add_article("before")
+    client.send("/show_articles")
+    client.send("/start")
+    client.send("/start")
+
+    outage["down"] = True
+    assert client.add_article("during") == handlers.ARTICLE_CREATED_MSG
+    client.send("/mark_articles")
+    assert client.press(handlers.CALLBACK_MARK_ALL) == (
+        handlers.ARTICLES_MARKED_READ_LATER_MSG
+    )
+    assert write_journal.depth > 0
+    assert journal.breaker.is_open
+    assert journal.replay() == 0
+
+    outage["down"] = False
+    journal.breaker.reset_timeout = 0
+    depth = write_journal.depth
+    assert journal.replay() == depth
+    assert write_journal.depth == 0
+    assert not journal.breaker.is_open
+
+    articles = db.Article.select().order_by(db.Article.id)
+    assert [(a.text, a.status) for a in articles] == [
+        ("before", db.ARTICLE_STATUS_READ),
+        ("during", db.ARTICLE_STATUS_READ),
+    ]
+    stats = db.UserStats.get()
+    assert (stats.saved_count, stats.read_count, stats.unread_count) == (2, 2, 0)
+
+
+def test_replay_keeps_writes_that_fail(outage, write_journal):
+    user = db.create_telegram_user(123, 42, "Ann", {"state": 1})
+    outage["down"] = True
+    db.create_article(user, "article")
+    assert write_journal.depth == 1
+
+    journal.breaker.reset_timeout = 0
+    assert journal.replay() == 0
+    assert write_journal.depth == 1
+
+    outage["down"] = False
+    assert journal.replay() == 1
+    assert db.Article.get().text == "article"
+
+
+def fail_article_create(monkeypatch):
+    def create(**kwargs):
+        raise IntegrityError("violates check constraint")
+
+    monkeypatch.setattr(db.Article, "create", create)
+
+
+def test_failed_writes_are_not_journaled(monkeypatch, client, write_journal):
+    client.register()
+    fail_article_create(monkeypatch)
+    assert client.add_article("article") == handlers.ERROR_MSG
+    assert write_journal.depth == 0
+    assert not journal.breaker.is_open
+
+
+def test_replay_drops_writes_that_fail(monkeypatch, outage, write_journal):
+    user = db.create_telegram_user(123, 42, "Ann", {"state": 1})
+    outage["down"] = True
+    db.create_article(user, "article")
+    db.mark_articles_read(user.id)
+    dropped = journal.JOURNAL_DROPPED.labels("create_article")
+
+    outage["down"] = False
+    journal.breaker.reset_timeout = 0
+    fail_article_create(monkeypatch)
+    before = dropped._value.get()
+    assert journal.replay() == 2
+    assert write_journal.depth == 0
+    assert dropped._value.get() == before + 1
+
+
+def test_reads_are_served_from_cache(client, outage):
+    client.register()
+    client.add_article("article")
+    user = db.get_telegram_user(123, 42)
+    assert db.get_user_articles(user.id)
+
+    outage["down"] = True
+    assert db.get_telegram_user(123, 42).id == user.id
+    assert [a.preview for a in db.get_user_articles(user.id)] == ["article"]
+    assert db.get_user_settings(user.id).reading_list_size == 5
+
+
+def test_journaled_articles_count_during_outage(client, outage, write_journal):
+    client.register(list_size=3)
+    client.add_article("before")
+    article = db.Article.get()
+    outage["down"] = True
+
+    assert client.add_article("before") == handlers.ARTICLE_ALREADY_EXISTS_MSG
+    assert client.add_article("during") == handlers.ARTICLE_CREATED_MSG
+    assert client.add_article("during") == handlers.ARTICLE_ALREADY_EXISTS_MSG
+    assert client.add_article("last") == handlers.ARTICLE_CREATED_MSG
+    assert client.add_article("too many") == handlers.LIST_IS_FULL_MSG
+
+    client.send("/show_articles")
+    assert client.last_markup.keyboard == [[f"{article.id} before"]]
+
+
+def test_add_article_with_cold_cache_during_outage(client, outage, write_journal):
+    client.register()
+    outage["down"] = True
+    for c in (db.articles_cache, db.settings_cache):
+        c.clear()
+    assert client.send("article") == handlers.ERROR_MSG
+
+
+def test_failed_probe_does_not_block_breaker(monkeypatch):
+    breaker = journal.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    monkeypatch.setattr(journal, "breaker", breaker)
+
+    @journal.cached_read()
+    def read():
+        raise KeyError("not a database error")
+
+    breaker.record_failure()
+    with pytest.raises(KeyError):
+        read()
+    assert breaker.allow_request()
+
+
+def test_breaker_opens_on_failures_and_closes_after_probe():
+    breaker = journal.CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    assert not breaker.is_open
+    breaker.record_failure()
+    assert breaker.is_open
+
+    assert breaker.allow_request()
+    # Only one probe at a time.
+    assert not breaker.allow_request()
+    breaker.record_success(0)
+    assert not breaker.is_open
+
+
+def test_slow_calls_count_as_failures():
+    breaker = journal.CircuitBreaker(failure_threshold=1, slow_call_seconds=0.1)
+    breaker.record_success(1.0)
+    assert breaker.is_open
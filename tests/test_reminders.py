@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import NetworkError, Unauthorized
+
+from bot import db, handlers
+from bot.reminders import (
+    REMINDER_RETRY_DELAY,
+    ReminderScheduler,
+    get_remind_at,
+)
+
+from conftest import FakeBot
+
+NOW = datetime(2026, 1, 1, 12)
+WINDOW = timedelta(hours=1)
+
+
+def test_get_remind_at():
+    assert get_remind_at(NOW, 3) == NOW + timedelta(days=2)
+    assert get_remind_at(NOW, 1) == NOW + timedelta(hours=12)
+
+
+def test_first_load_has_no_start():
+    scheduler = ReminderScheduler(WINDOW)
+    assert scheduler.next_load(NOW) == (None, NOW + WINDOW)
+    # A load is in progress.
+    assert scheduler.next_load(NOW) is None
+
+
+def test_window_is_extended_when_half_used():
+    scheduler = ReminderScheduler(WINDOW)
+    scheduler.next_load(NOW)
+    scheduler.loaded([])
+    assert scheduler.next_load(NOW + WINDOW / 4) is None
+    assert scheduler.next_load(NOW + WINDOW / 2) == (NOW + WINDOW, NOW + WINDOW * 1.5)
+
+
+def test_failed_load_is_retried():
+    scheduler = ReminderScheduler(WINDOW)
+    scheduler.next_load(NOW)
+    scheduler.loaded(None)
+    assert scheduler.next_load(NOW) == (None, NOW + WINDOW)
+
+
+def test_pop_due_in_order():
+    scheduler = ReminderScheduler(WINDOW)
+    scheduler.next_load(NOW)
+    scheduler.loaded([(1, NOW + timedelta(minutes=2)), (2, NOW + timedelta(minutes=1))])
+    scheduler.loaded([(3, NOW + timedelta(minutes=3))])
+
+    assert scheduler.pop_due(NOW, 10) == []
+    assert scheduler.pop_due(NOW + timedelta(minutes=2), 1) == [
+        (2, NOW + timedelta(minutes=1))
+    ]
+    assert scheduler.pop_due(NOW + timedelta(minutes=5), 10) == [
+        (1, NOW + timedelta(minutes=2)),
+        (3, NOW + timedelta(minutes=3)),
+    ]
+    assert len(scheduler) == 0
+
+
+def test_schedule_only_inside_loaded_window():
+    scheduler = ReminderScheduler(WINDOW)
+    scheduler.schedule(1, NOW)
+    assert len(scheduler) == 0
+
+    scheduler.next_load(NOW)
+    scheduler.loaded([])
+    scheduler.schedule(2, NOW + WINDOW / 2)
+    scheduler.schedule(3, NOW + WINDOW * 2)
+    assert [i for i, _ in scheduler.pop_due(NOW + WINDOW * 3, 10)] == [2]
+
+
+def test_schedule_during_load_is_kept():
+    scheduler = ReminderScheduler(WINDOW)
+    scheduler.next_load(NOW)
+    scheduler.schedule(1, NOW)
+    scheduler.loaded([(1, NOW)])
+    assert scheduler.pop_due(NOW, 10) == [(1, NOW)]
+
+
+def test_cancel_and_reschedule():
+    scheduler = ReminderScheduler(WINDOW)
+    scheduler.next_load(NOW)
+    scheduler.loaded([(1, NOW), (2, NOW)])
+    scheduler.cancel([1])
+    scheduler.schedule(2, NOW + timedelta(minutes=1))
+
+    assert scheduler.pop_due(NOW, 10) == []
+    assert scheduler.pop_due(NOW + WINDOW, 10) == [(2, NOW + timedelta(minutes=1))]
+
+
+def test_requeue():
+    scheduler = ReminderScheduler(WINDOW)
+    scheduler.next_load(NOW)
+    scheduler.loaded([(1, NOW)])
+    due = scheduler.pop_due(NOW, 10)
+    scheduler.requeue(due)
+    assert scheduler.pop_due(NOW, 10) == due
+
+
+class FailingBot(FakeBot):
+    def __init__(self, errors):
+        super().__init__()
+        self.errors = errors
+
+    def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.errors:
+            raise self.errors[chat_id]
+        return super().send_message(chat_id, text, **kwargs)
+
+
+@pytest.fixture
+def reminder_articles():
+    """One article due for a reminder for each of three users."""
+    ids = []
+    for telegram_id in (1, 2, 3):
+        user = db.create_telegram_user(123, telegram_id, "Ann", {"state": 1})
+        article = db.create_article(user, f"article {telegram_id}", 3)
+        ids.append(article.id)
+    db.Article.update(remind_at=db.utcnow() - timedelta(minutes=1)).execute()
+    return ids
+
+
+def send_reminders(bot):
+    dispatcher = SimpleNamespace(bot_data={handlers.BOTS: {123: bot}})
+    handlers.send_reminders(SimpleNamespace(dispatcher=dispatcher))
+
+
+def reminded_ids():
+    return {
+        a.id for a in db.Article.select().where(db.Article.remind_at.is_null(False))
+    }
+
+
+def test_send_reminders(reminder_articles):
+    bot = FakeBot()
+    send_reminders(bot)
+
+    assert sorted(chat_id for chat_id, _, _ in bot.sent) == [1, 2, 3]
+    assert bot.sent[0][1] == f"{handlers.REMINDER_MSG}\narticle 1"
+    assert reminded_ids() == set()
+    send_reminders(bot)
+    assert len(bot.sent) == 3
+
+
+def test_failed_reminders_are_retried(reminder_articles):
+    bot = FailingBot({1: NetworkError("timeout"), 2: Unauthorized("blocked")})
+    send_reminders(bot)
+
+    assert [chat_id for chat_id, _, _ in bot.sent] == [3]
+    assert reminded_ids() == {reminder_articles[0]}
+    retry = handlers.reminder_scheduler.pop_due(
+        db.utcnow() + REMINDER_RETRY_DELAY * 2, 10
+    )
+    assert [article_id for article_id, _ in retry] == [reminder_articles[0]]